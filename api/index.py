@@ -1,51 +1,92 @@
-import os
-import json
 import asyncio
-from bot import bot, dp
-from aiogram.types import Update
-
-async def handler(request):
-    if request.method == "POST":
-        try:
-            data = await request.json()
-            update = Update.model_validate(data, context={"bot": bot})
-            await dp.feed_update(bot, update)
-            return {"statusCode": 200, "body": "OK"}
-        except Exception as e:
-            print(f"Error: {e}")
-            return {"statusCode": 500, "body": str(e)}
-    return {"statusCode": 200, "body": "Bot is running"}
-
-# Vercel entry point
-def index(request):
-    # Vercel passes a request object, but for async handling we might need a wrapper
-    # However, Vercel Python runtime supports async handlers if defined correctly.
-    # Standard Vercel Python is WSGI. For async, we usually use a framework or run_until_complete.
-    
-    # Simple synchronous wrapper for Vercel's WSGI-like environment if needed,
-    # but Vercel also supports Sanic/FastAPI.
-    # Let's assume standard Vercel Python function signature.
-    
-    # Actually, for Vercel Serverless Functions with Python, it's often easier to use
-    # a micro-framework like FastAPI or just handle the raw request.
-    # Let's try the raw request approach compatible with Vercel's `http.server` style.
-    pass
-
-# Better approach: Use FastAPI for Vercel
+import importlib
+import logging
+import time
+
+# Reference point for the cold start timings
+STARTED = time.perf_counter()
+
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
+from fastapi.responses import Response
+from metrics import render, CONTENT_TYPE, STARTUP_SECONDS, metrics_authorized
+from webhook import update_queue, WEBHOOK_SECRET, SECRET_HEADER
+
+# The bot module (aiogram, yt-dlp, the database) is imported in the background,
+# so the first request is acknowledged without waiting for it
+_startup = None
+
+
+async def _start_bot():
+    started = time.perf_counter()
+    bot_module = await asyncio.to_thread(importlib.import_module, "bot")
+    logging.info(f"Bot module imported in {time.perf_counter() - started:.2f}s")
+    await bot_module.on_startup(serve_metrics=False)
+    await update_queue.start(bot_module.bot, bot_module.dp)
+    STARTUP_SECONDS.set(time.perf_counter() - STARTED, phase="ready")
+    return bot_module
+
+
+def _ensure_started() -> asyncio.Task:
+    global _startup
+    if _startup is None:
+        _startup = asyncio.create_task(_start_bot())
+    return _startup
 
-app = FastAPI()
+
+def _startup_failed() -> bool:
+    """True if startup failed; it is then forgotten, so the next request starts again."""
+    global _startup
+    if _startup is None or not _startup.done():
+        return False
+    if not _startup.cancelled() and _startup.exception() is None:
+        return False
+    logging.error(f"Bot startup failed, retrying on the next update: "
+                  f"{'cancelled' if _startup.cancelled() else _startup.exception()}")
+    _startup = None
+    return True
+
+
+@asynccontextmanager
+async def lifespan(app):
+    _ensure_started()
+    yield
+    await update_queue.stop()
+    # A failed startup is forgotten (set to None) so the next request retries it
+    if _startup is not None and _startup.done() and not _startup.cancelled() and _startup.exception() is None:
+        await _startup.result().on_shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 @app.post("/api/index")
 async def webhook(request: Request):
+    if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    # Nothing would ever handle the update: let Telegram redeliver it
+    if _startup_failed():
+        return Response(status_code=503)
+    _ensure_started()
     try:
         data = await request.json()
-        update = Update.model_validate(data, context={"bot": bot})
-        await dp.feed_update(bot, update)
-        return {"status": "ok"}
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
+    except ValueError:
+        return Response(status_code=400)
+    # Acknowledge right away; a non-2xx makes Telegram redeliver later
+    if not update_queue.put(data):
+        return Response(status_code=503)
+    return {"status": "ok"}
 
 @app.get("/api/index")
 async def status():
-    return {"status": "active"}
+    startup = _ensure_started()
+    if not startup.done():
+        return {"status": "starting", "queued": len(update_queue)}
+    if startup.cancelled() or startup.exception() is not None:
+        return {"status": "error", "message": "cancelled" if startup.cancelled() else str(startup.exception())}
+    return {"status": "active", "queued": len(update_queue)}
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    if not metrics_authorized(request.headers.get("Authorization", "")):
+        return Response(status_code=404)
+    return Response(content=render(), media_type=CONTENT_TYPE)
@@ -1,16 +1,46 @@
 import asyncio
 import logging
 import os
-import re
 import sys
+import time
+
+# Reference point for the startup timings
+STARTED = time.perf_counter()
+
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
-from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaAudio, InputMediaVideo
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from config import API_TOKEN, API_ID, API_HASH
-from downloader import download_video, download_spotify
-from database import is_user_allowed, add_user, migrate_from_file, get_user_count
+from uploader import uploader, STREAMING_UPLOADS
+from inflight import InFlightRegistry
+from scheduler import JobScheduler, get_job_priority, DOWNLOAD_WORKERS
+from coordination import WORKER_ID, WORKER_ROLE, HEARTBEAT_TIMEOUT, wait_remote_flight
+from postprocess import make_streamable, compress_to_size, extract_audio, HAS_FFMPEG
+from media_cache import media_cache, media_key
+from stats import stats_writer
+from progress import progress_dispatcher
+from storage import disk_budget, estimate_job_bytes, NotEnoughDiskSpace
+from webhook import update_queue, start_webhook_server, WEBHOOK_URL, WEBHOOK_SECRET
+from profiling import profile_stage, new_trace_id, list_profiles, get_profile_files
+from metrics import (
+    Gauge, METRICS_PORT, start_metrics_server, STARTUP_SECONDS, REQUESTS, MEDIA_CACHE, DOWNLOAD_SECONDS, DOWNLOAD_BYTES,
+    DOWNLOAD_SPEED, UPLOAD_SECONDS, UPLOAD_BYTES, UPLOAD_SPEED,
+)
+from retry import backoff_delay
+from downloader import (
+    download_video, download_spotify, normalize_url, get_video_info, get_quality_options, process_pool,
+    select_format, stream_video, is_collection_url, expand_collection, download_collection,
+    remove_download, pick_format_under, DOWNLOAD_DIR, get_platform,
+)
+from database import (
+    is_user_allowed, add_user, migrate_from_file, get_user_count, run_db, close_db,
+    get_cached_file, save_cached_file, delete_cached_file, get_user_jobs,
+    get_queue_position, set_job_work_dir, get_job_work_dir, get_active_work_dirs, get_active_job_ids,
+    get_download_stats,
+    claim_flight, release_flight, save_selection, get_selection, delete_selection,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -20,6 +50,7 @@ logging.basicConfig(
 )
 
 import random
+import secrets
 
 # ... imports ...
 
@@ -34,8 +65,22 @@ if not API_ID or not API_HASH:
 bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
 
-# Store user URLs temporarily: {user_id: url}
-user_urls = {}
+# Fire-and-forget tasks (kept referenced until done)
+background_tasks = set()
+
+# Downloads in progress, shared by users requesting the same media
+in_flight = InFlightRegistry()
+
+# Attempts of a large (MTProto) upload; each one resumes the previous
+UPLOAD_ATTEMPTS = int(os.environ.get("UPLOAD_ATTEMPTS", 3))
+
+# Quality keyboards stay usable this long; at most SELECTION_LIMIT of them are kept
+SELECTION_TTL = int(os.environ.get("SELECTION_TTL", 24 * 3600))
+SELECTION_LIMIT = int(os.environ.get("SELECTION_LIMIT", 10000))
+
+# Playlists, albums and carousels: max items and parallel downloads per batch
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 20))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 3))
 
 
 async def check_auth(message: types.Message):
@@ -43,7 +88,7 @@ async def check_auth(message: types.Message):
     if message.from_user.id == 177036997:
         return True
 
-    if not is_user_allowed(message.from_user.id):
+    if not await run_db(is_user_allowed, message.from_user.id):
         jokes = [
             "⛔️ **Доступ запрещен!**\nМой создатель не разрешал мне разговаривать с незнакомцами.",
             "🕵️ **Вы кто?**\nВас нет в списках VIP. Предъявите пропуск или коробку конфет администратору.",
@@ -89,12 +134,12 @@ async def cmd_add_user(message: types.Message):
                 new_user_id = int(stdout.decode().strip())
 
                 # Check if already exists
-                if is_user_allowed(new_user_id):
+                if await run_db(is_user_allowed, new_user_id):
                     await status_msg.edit_text(f"⚠️ Пользователь @{username} (ID: {new_user_id}) уже есть в списке.")
                     return
 
                 # Add to database
-                if add_user(new_user_id, username, added_by="admin"):
+                if await run_db(add_user, new_user_id, username, added_by="admin"):
                     await status_msg.edit_text(f"✅ Пользователь @{username} (ID: `{new_user_id}`) успешно добавлен!")
                 else:
                     await status_msg.edit_text(f"❌ Ошибка добавления пользователя в базу данных.")
@@ -118,15 +163,124 @@ async def cmd_start(message: types.Message):
     )
     logging.info(f"User {message.from_user.id} started the bot")
 
-def get_quality_keyboard():
+@dp.message(Command("queue"))
+async def cmd_queue(message: types.Message):
+    if not await check_auth(message):
+        return
+
+    jobs = await run_db(get_user_jobs, message.from_user.id)
+    if not jobs:
+        await message.answer("У вас нет загрузок в очереди.")
+        return
+
+    lines = []
+    for job in jobs:
+        if job["status"] == "running":
+            state = "⬇️ скачивается"
+        else:
+            state = f"⏳ позиция {await run_db(get_queue_position, job['id']) + 1}"
+        lines.append(f"{state}: {job['url']} ({job['quality']})")
+    await message.answer("\n".join(lines), disable_web_page_preview=True)
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    # Admin check
+    if message.from_user.id != 177036997:
+        return
+
+    args = message.text.split()
+    days = int(args[1]) if len(args) > 1 and args[1].isdigit() else 7
+    rows = await run_db(get_download_stats, days)
+    if not rows:
+        await message.answer(f"За {days} дн. загрузок не было.")
+        return
+
+    lines = [f"📊 **Статистика за {days} дн.**"]
+    for row in rows:
+        speed = f"{row['bytes_per_second'] / 1024 / 1024:.1f} MB/s" if row["bytes_per_second"] else "—"
+        if row["p50"] is not None:
+            latency = f"p50 {row['p50']:.1f}s · p90 {row['p90']:.1f}s · p99 {row['p99']:.1f}s"
+        else:
+            latency = "—"
+        lines.append(
+            f"\n**{row['platform']}**: {row['requests']} запросов, успешно {row['done']}, "
+            f"из кэша {row['cache_hits']}\n"
+            f"📥 {row['bytes'] / 1024 / 1024:.0f} MB, {speed}\n"
+            f"⏱ {latency}"
+        )
+    await message.answer("\n".join(lines))
+
+@dp.message(Command("profiles"))
+async def cmd_profiles(message: types.Message):
+    # Admin check
+    if message.from_user.id != 177036997:
+        return
+
+    profiles = list_profiles()
+    if not profiles:
+        await message.answer("Профилей медленных задач нет (включается через PROFILING=1).")
+        return
+    lines = ["🐢 **Медленные задачи:**"]
+    for trace_id, stage, header in profiles:
+        lines.append(f"`{trace_id}` {stage}: {header.split(' ', 2)[-1]}")
+    lines.append("\nПодробности: /profile <trace>")
+    await message.answer("\n".join(lines))
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    # Admin check
+    if message.from_user.id != 177036997:
+        return
+
+    args = message.text.split()
+    if len(args) < 2:
+        await message.answer("ℹ️ **Использование:** `/profile <trace>`")
+        return
+    files = get_profile_files(args[1])
+    if not files:
+        await message.answer("Профиль не найден.")
+        return
+    for path in files:
+        await message.answer_document(FSInputFile(path))
+
+def get_quality_keyboard(token: str, info=None):
+    """Quality buttons; callback_data is "quality_<quality>_<token>" (token of the stored URL)."""
     builder = InlineKeyboardBuilder()
-    builder.button(text="1080p", callback_data="quality_1080")
-    builder.button(text="720p", callback_data="quality_720")
-    builder.button(text="360p", callback_data="quality_360")
-    builder.button(text="Audio Only", callback_data="quality_audio")
+    options = get_quality_options(info) if info else []
+    if options:
+        # Buttons for the heights the video really has, with expected sizes
+        for height, size in options:
+            text = f"{height}p" if not size else f"{height}p · {size / 1024 / 1024:.0f} MB"
+            builder.button(text=text, callback_data=f"quality_{height}_{token}")
+        # Some heights would take the slow MTProto path: offer the best one that does not
+        limit = get_large_file_threshold()
+        if any(size and size > limit for _, size in options):
+            fitting = pick_format_under(info, limit, allow_merge=HAS_FFMPEG)
+            if fitting:
+                _, height, size = fitting
+                builder.button(text=f"⚡ {height}p · {size / 1024 / 1024:.0f} MB (быстро)", callback_data=f"quality_fit_{token}")
+            elif HAS_FFMPEG:
+                builder.button(text=f"⚡ Сжать до {limit // 1024 // 1024} MB", callback_data=f"quality_fit_{token}")
+    else:
+        builder.button(text="1080p", callback_data=f"quality_1080_{token}")
+        builder.button(text="720p", callback_data=f"quality_720_{token}")
+        builder.button(text="360p", callback_data=f"quality_360_{token}")
+    builder.button(text="Audio Only", callback_data=f"quality_audio_{token}")
     builder.adjust(2)
     return builder.as_markup()
 
+async def prefetch_info(url: str, keyboard_msg: types.Message, token: str):
+    """Extract formats while the user is choosing, then show the real options."""
+    try:
+        info = await get_video_info(url)
+        # Skip if the user has already picked a quality (possibly on another node)
+        if not await run_db(get_selection, token, SELECTION_TTL):
+            return
+        if info and get_quality_options(info):
+            await keyboard_msg.edit_reply_markup(reply_markup=get_quality_keyboard(token, info))
+    except Exception as e:
+        logging.warning(f"Prefetch failed for {url}: {e}")
+
 @dp.message(Command("kir"))
 async def cmd_kir(message: types.Message):
     try:
@@ -152,12 +306,12 @@ async def secret_code_handler(message: types.Message):
     username = message.from_user.username or "Unknown"
     
     # Check if already allowed
-    if is_user_allowed(user_id):
+    if await run_db(is_user_allowed, user_id):
         await message.answer("Ты уже в клубе, бро! 😎")
         return
 
     # Add to database
-    if add_user(user_id, username, added_by="secret_code"):
+    if await run_db(add_user, user_id, username, added_by="secret_code"):
         await message.answer("✅ Доступ получен! Добро пожаловать в элитный клуб.\nТеперь можешь скидывать ссылки.")
         logging.info(f"User {username} ({user_id}) added via secret code.")
 
@@ -186,35 +340,55 @@ async def handle_url(message: types.Message):
 
     # Check if YouTube
     if "youtube.com" in url or "youtu.be" in url:
-        user_urls[user_id] = url
-        await message.answer(
+        # Each link gets its own token, so several keyboards can be open at once;
+        # kept in the database, as the choice may arrive after a restart or at another node
+        token = secrets.token_urlsafe(6)
+        if not await run_db(save_selection, token, user_id, url, SELECTION_TTL, SELECTION_LIMIT):
+            await message.answer("Что-то пошло не так. Попробуй ещё раз.")
+            return
+        keyboard_msg = await message.answer(
             "Выбери качество видео:",
-            reply_markup=get_quality_keyboard()
+            reply_markup=get_quality_keyboard(token)
         )
+        # Start extraction now, the download will reuse it. Not for playlists and
+        # channels: those are listed flat when the download starts
+        if not is_collection_url(url):
+            task = asyncio.create_task(prefetch_info(url, keyboard_msg, token))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
     # Check if Instagram
     elif "instagram.com" in url:
         await message.answer("Скачиваю видео с Instagram...")
-        await process_download(message, url, quality="best")
+        await enqueue_download(message, url, "best", user_id)
     # Check if Spotify
     elif "spotify.com" in url:
         await message.answer("🎧 Скачиваю музыку со Spotify...")
-        await process_download(message, url, quality="spotify")
+        await enqueue_download(message, url, "spotify", user_id)
     else:
         # Try generic download
         await message.answer("Пробую скачать по ссылке...")
-        await process_download(message, url, quality="best")
+        await enqueue_download(message, url, "best", user_id)
 
 @dp.callback_query(F.data.startswith("quality_"))
 async def handle_quality_selection(callback: types.CallbackQuery):
-    quality = callback.data.split("_")[1]
+    # Keyboards sent before tokens existed have no token part: treated as expired
+    _, quality, token = (callback.data.split("_", 2) + [""])[:3]
     user_id = callback.from_user.id
-    url = user_urls.get(user_id)
+    selection = await run_db(get_selection, token, SELECTION_TTL) if token else None
 
-    if not url:
+    if not selection:
         await callback.message.answer("Ссылка устарела. Отправь её снова.")
         await callback.answer()
         return
+    if selection[0] != user_id:
+        await callback.answer("Эти кнопки для другого пользователя.", show_alert=True)
+        return
 
+    if not await run_db(delete_selection, token):
+        # Already chosen (a double click)
+        await callback.answer()
+        return
+    url = selection[1]
     await callback.message.edit_text(f"Выбрано качество: {quality}. Скачиваю...")
     
     from aiogram.exceptions import TelegramBadRequest
@@ -222,232 +396,676 @@ async def handle_quality_selection(callback: types.CallbackQuery):
         await callback.answer()
     except TelegramBadRequest:
         pass
-    await process_download(callback.message, url, quality)
-
-def get_format_str(quality):
-    if quality == "1080":
-        return "bestvideo[height<=1080]+bestaudio/best[height<=1080]"
-    elif quality == "720":
-        return "bestvideo[height<=720]+bestaudio/best[height<=720]"
-    elif quality == "360":
-        return "bestvideo[height<=360]+bestaudio/best[height<=360]"
+    await enqueue_download(callback.message, url, quality, user_id)
+
+def get_format_str(quality, info=None):
+    if quality == "fit":
+        # Best rendition expected to fit under the Bot API upload threshold
+        fitting = pick_format_under(info, get_large_file_threshold(), allow_merge=HAS_FFMPEG) if info else None
+        if fitting:
+            return fitting[0]
+        # Nothing is known to fit: take a small rendition, compressed after download if needed
+        return get_format_str("480")
+    if quality.isdigit():
+        if not HAS_FFMPEG:
+            # Separate streams cannot be merged without ffmpeg
+            return f"best[height<={quality}]"
+        # H.264/AAC streams merge into an MP4 Telegram plays without re-encoding
+        return (f"bestvideo[height<={quality}][vcodec^=avc1]+bestaudio[ext=m4a]/"
+                f"bestvideo[height<={quality}]+bestaudio/best[height<={quality}]")
     elif quality == "audio":
         return "bestaudio/best"
     elif quality == "best":
         return "best"
     return "best"
 
-async def process_download(message: types.Message, url: str, quality: str):
-    global download_semaphore
-    
-    logging.info(f"Processing download for URL: {url} with quality: {quality} from user {message.chat.id}")
+def get_caption_text():
+    return f"Скачано с помощью @{BOT_USERNAME}" if BOT_USERNAME else "Скачано ботом"
+
+def get_sent_file(sent: types.Message):
+    """Return (file_id, media_type) of the media in a sent message."""
+    if sent.video:
+        return sent.video.file_id, "video"
+    if sent.audio:
+        return sent.audio.file_id, "audio"
+    if sent.document:
+        return sent.document.file_id, "document"
+    return None, None
+
+async def send_cached_file(message: types.Message, file_id: str, media_type: str):
+    caption_text = get_caption_text()
+    if media_type == "audio":
+        await message.answer_audio(file_id, caption=f"🎧 {caption_text}")
+    elif media_type == "video":
+        await message.answer_video(file_id, caption=f"📹 {caption_text}", supports_streaming=True)
+    else:
+        await message.answer_document(file_id, caption=caption_text)
+
+async def send_from_cache(message: types.Message, cache_key: str, quality: str) -> bool:
+    """Re-send an already uploaded file by file_id. Returns True on success."""
+    cached = await run_db(get_cached_file, cache_key, quality)
+    if not cached:
+        return False
+    file_id, media_type = cached
+    try:
+        await send_cached_file(message, file_id, media_type)
+        logging.info(f"Sent {cache_key} ({quality}) from file_id cache")
+        return True
+    except Exception as e:
+        logging.warning(f"Cached file_id for {cache_key} ({quality}) failed: {e}")
+        await run_db(delete_cached_file, cache_key, quality)
+        return False
+
+async def enqueue_download(message: types.Message, url: str, quality: str, user_id: int):
+    """Serve from cache or an in-flight download if possible, otherwise queue a job."""
+    cache_key = normalize_url(url)
+    started = time.time()
+    if await send_from_cache(message, cache_key, quality):
+        stats = new_request_stats(new_trace_id())
+        stats.update(status="done", upload_path="file_id", cache_hit=1)
+        record_request(user_id, url, quality, stats, started)
+        return
+    if in_flight.get((cache_key, quality)):
+        await process_download(message, url, quality, user_id)
+        return
+
+    busy = scheduler.is_busy
+    job_id, ahead = await scheduler.submit(user_id, message.chat.id, url, quality, message)
+    if job_id is None:
+        # Queue unavailable: download right away
+        await process_download(message, url, quality, user_id)
+        return
+    if busy or ahead:
+        await message.answer(f"⏳ **Бот занят.**\nВы в очереди, позиция: {ahead + 1}")
+
+async def run_job(job: dict, message: types.Message = None):
+    """Scheduler runner: download a queued job."""
+    if message is None and job["attempts"] == 0:
+        # Queued by another node
+        message = await bot.send_message(job["chat_id"], "⏳ Начинаю загрузку...")
+    elif message is None:
+        # Recovered after a restart: the original message object is gone
+        message = await bot.send_message(job["chat_id"], "🔄 Продолжаю загрузку после перезапуска...")
+    await process_download(message, job["url"], job["quality"], job["user_id"], job["id"])
+
+async def process_download(message: types.Message, url: str, quality: str, user_id: int, job_id: int = None):
+    # user_id is passed in: on a quality button's message from_user is the bot itself
+    trace_id = new_trace_id()
+    logging.info(f"Processing download for URL: {url} with quality: {quality} from user {user_id}"
+                 f" (trace {trace_id})")
+    started = time.time()
+    # Filled in along the way and written to download_stats at the end
+    stats = new_request_stats(trace_id)
+    try:
+        await _process_download(message, url, quality, job_id, stats)
+    finally:
+        record_request(user_id, url, quality, stats, started)
+
+def new_request_stats(trace_id: str) -> dict:
+    return {"status": "failed", "upload_path": None, "cache_hit": 0, "file_size": None,
+            "download_seconds": None, "upload_seconds": None, "trace_id": trace_id}
+
+def record_request(user_id: int, url: str, quality: str, stats: dict, started: float):
+    """Write a finished request to download_stats and the metrics."""
+    platform = get_platform(url)
+    stats_writer.record(
+        user_id=user_id, url=url, platform=platform, quality=quality,
+        total_seconds=time.time() - started, **stats
+    )
+    observe_request(platform, stats)
 
-    # Notify if queue is full
-    if download_semaphore.locked():
-        await message.answer("⏳ **Бот занят другим скачиванием.**\nВы добавлены в очередь, пожалуйста подождите...")
+def observe_request(platform: str, stats: dict):
+    """Feed the per-stage metrics from a finished request's stats."""
+    REQUESTS.inc(platform=platform, status=stats["status"], upload_path=stats["upload_path"] or "none")
+    size = stats["file_size"] or 0
+    if stats["download_seconds"] and not stats["cache_hit"]:
+        DOWNLOAD_SECONDS.observe(stats["download_seconds"], platform=platform)
+        if size:
+            DOWNLOAD_BYTES.inc(size, platform=platform)
+            DOWNLOAD_SPEED.observe(size / stats["download_seconds"], platform=platform)
+    if stats["upload_seconds"]:
+        UPLOAD_SECONDS.observe(stats["upload_seconds"], path=stats["upload_path"])
+        if size:
+            UPLOAD_BYTES.inc(size, path=stats["upload_path"])
+            UPLOAD_SPEED.observe(size / stats["upload_seconds"], path=stats["upload_path"])
+
+async def _process_download(message: types.Message, url: str, quality: str, job_id: int, stats: dict):
+    # Playlists, albums and carousels are downloaded item by item
+    if is_collection_url(url) and await process_batch(message, url, quality):
+        stats.update(status="done", upload_path="batch")
+        return
+
+    # Already uploaded once? Re-send by file_id without downloading
+    cache_key = normalize_url(url)
+    if await send_from_cache(message, cache_key, quality):
+        stats.update(status="done", upload_path="file_id", cache_hit=1)
+        return
+
+    # Same media is already being downloaded for someone else? Attach to it
+    flight_key = (cache_key, quality)
+    flight = in_flight.get(flight_key)
+    if flight:
+        status_msg = await message.answer("⏳ Эту ссылку уже скачивают, подключаю вас к загрузке...")
+        flight.attach(status_msg)
+        result = await flight.wait()
+        if result:
+            await send_cached_file(message, *result)
+            stats.update(status="done", upload_path="file_id", cache_hit=1)
+        else:
+            await message.answer("Не удалось скачать файл. Возможно, он недоступен.")
+        return
+
+    flight = in_flight.start(flight_key)
+    flight.attach(message)
+    try:
+        # Another node downloading it? Wait for its upload (or take over if it fails)
+        while not await run_db(claim_flight, cache_key, quality, WORKER_ID, HEARTBEAT_TIMEOUT):
+            await flight.edit_text("⏳ Эту ссылку уже скачивают, подключаю вас к загрузке...")
+            result = await wait_remote_flight(cache_key, quality)
+            if result:
+                flight.resolve(*result)
+                await send_cached_file(message, *result)
+                stats.update(status="done", upload_path="file_id", cache_hit=1)
+                return
 
-    async with download_semaphore:
         try:
-            # Progress update logic
-            last_edit_time = 0
-            
-            def progress_handler(d):
-                nonlocal last_edit_time
-                import time
-                current_time = time.time()
-                
-                # Update every 3 seconds to avoid flood limits
-                if current_time - last_edit_time < 3:
+            # Single-file formats can skip staging on disk, and so need no disk space
+            if STREAMING_UPLOADS and uploader.is_available and quality in ("best", "audio"):
+                if await stream_and_send(message, url, quality, cache_key, flight, stats):
                     return
 
-                percent = d.get('_percent_str', 'N/A')
-                eta = d.get('_eta_str', 'N/A')
-                speed = d.get('_speed_str', 'N/A')
-                
-                # Clean up ANSI codes if present
-                percent = re.sub(r'\x1b\[[0-9;]*m', '', str(percent))
-                eta = re.sub(r'\x1b\[[0-9;]*m', '', str(eta))
-                speed = re.sub(r'\x1b\[[0-9;]*m', '', str(speed))
-                
-                text = f"📥 **Скачиваю:** {percent}\n🚀 **Скорость:** {speed}\n⏳ **Осталось:** {eta}"
-                
-                try:
-                    # Schedule async update in the main loop
-                    asyncio.run_coroutine_threadsafe(
-                        message.edit_text(text),
-                        asyncio.get_running_loop()
-                    )
-                    last_edit_time = current_time
-                except Exception:
-                    pass
+            # A job keeps its directory across retries and restarts, so it resumes the partial download
+            work_dir = await run_db(get_job_work_dir, job_id) if job_id is not None else None
+            estimate, guessed = await estimate_disk_usage(url, quality)
+            try:
+                async with disk_budget.reserved(estimate, work_dir, job_id, disk_wait_notice(flight),
+                                                guessed) as reservation:
+                    if job_id is not None and work_dir is None:
+                        await run_db(set_job_work_dir, job_id, reservation.directory)
+                    await download_and_send(message, url, quality, cache_key, flight, reservation.directory, stats)
+            except NotEnoughDiskSpace as e:
+                logging.error(f"Refusing {url} ({quality}): {e}")
+                await message.answer("💾 Файл слишком большой: на диске не хватит места.")
+        finally:
+            await run_db(release_flight, cache_key, quality, WORKER_ID)
+    finally:
+        progress_dispatcher.clear(flight)
+        in_flight.finish(flight)
+
+async def estimate_disk_usage(url: str, quality: str):
+    """Peak temporary disk use expected for a download (from the extracted format sizes).
+
+    Returns (bytes, guessed), as storage.estimate_job_bytes.
+    """
+    audio = quality in ("audio", "spotify")
+    if quality == "spotify":
+        return estimate_job_bytes(None, audio)
+    info = await get_video_info(url)
+    selected = await select_format(info, get_format_str(quality, info)) if info else None
+    return estimate_job_bytes(selected, audio)
+
+def disk_wait_notice(target):
+    """on_wait callback for disk_budget: tell the user the job waits for disk space."""
+    async def notify():
+        try:
+            await target.edit_text("💾 Жду, пока освободится место на диске...")
+        except Exception:
+            pass
+    return notify
+
+def get_large_file_threshold():
+    # Use Pyrogram (uploader.py) for larger files if credentials are available
+    # Lower threshold to 40MB to avoid timeouts with Bot API on slower connections
+    return 40 * 1024 * 1024 if (API_ID and API_HASH) else 49 * 1024 * 1024
+
+async def process_batch(message: types.Message, url: str, quality: str) -> bool:
+    """Download every item of a playlist, album or carousel and send them as media groups.
+
+    Returns False if the URL turned out to be a single item.
+    """
+    status_msg = await message.answer("📚 Получаю список файлов...")
+    media_type = "audio" if quality in ("audio", "spotify") else "video"
+
+    collection = None
+    if quality != "spotify":
+        collection = await expand_collection(url, BATCH_MAX_ITEMS)
+        if collection is None:
+            try:
+                await status_msg.delete()
+            except Exception:
+                pass
+            return False
 
+    # Every file of the batch goes to the reservation's directory, deleted when the batch is sent.
+    # Items downloaded one by one reserve their own space; spotDL and one yt-dlp run for a whole
+    # collection report no sizes: reserve defaults for the files they keep on disk at once
+    if quality == "spotify":
+        estimate = estimate_job_bytes(None, audio=True)[0] * BATCH_MAX_ITEMS
+    elif collection[1]:
+        estimate = 0
+    else:
+        estimate = estimate_job_bytes(None, media_type == "audio")[0] * BATCH_CONCURRENCY
+    try:
+        async with disk_budget.reserved(estimate, on_wait=disk_wait_notice(status_msg), guessed=True) as reservation:
             if quality == "spotify":
-                file_path = await download_spotify(url)
+                await status_msg.edit_text("🎧 Скачиваю альбом со Spotify...")
+
+                files = await download_spotify(url, progress_dispatcher.callback(status_msg, "tracks"),
+                                               reservation.directory, BATCH_MAX_ITEMS)
+                progress_dispatcher.clear(status_msg)
+                items = [(None, None, path) for path in files]
             else:
+                title, item_urls = collection
                 format_str = get_format_str(quality)
-                # Pass progress_handler only for video downloads
-                file_path = await download_video(url, format_str, progress_callback=progress_handler)
-            
-            if not file_path or not os.path.exists(file_path):
-                logging.error(f"Download failed: file not found at {file_path}")
-                await message.answer("Не удалось скачать файл. Возможно, он недоступен.")
-                return
+                if item_urls is None:
+                    # Only nested collections (e.g. a channel without tabs to expand)
+                    items = []
+                elif item_urls:
+                    items = await download_batch_items(status_msg, item_urls, quality, format_str, reservation.directory)
+                else:
+                    # Items are not addressable one by one: one yt-dlp run for all
+                    await status_msg.edit_text(f"📚 Скачиваю {title}...")
+                    paths = await download_collection(url, format_str, BATCH_MAX_ITEMS, reservation.directory)
+                    items = [(None, None, path) for path in paths]
 
-            # Check file size (Telegram limit ~50MB for bots)
-            file_size = os.path.getsize(file_path)
-            logging.info(f"File downloaded: {file_path}, size: {file_size} bytes")
-            
-            # Use Pyrogram (uploader.py) for larger files if credentials are available
-            # Lower threshold to 40MB to avoid timeouts with Bot API on slower connections
-            large_file_threshold = 40 * 1024 * 1024 if (API_ID and API_HASH) else 49 * 1024 * 1024
+            if not items:
+                await status_msg.edit_text("Не удалось скачать файлы. Возможно, они недоступны.")
+                return True
+
+            sent_count = await send_batch(message, items, media_type, quality)
+            await status_msg.edit_text(f"✅ Готово: отправлено {sent_count} из {len(items)}")
+    except NotEnoughDiskSpace as e:
+        logging.error(f"Refusing batch {url}: {e}")
+        await status_msg.edit_text("💾 На диске не хватит места для этой подборки.")
+    return True
+
+async def download_batch_items(status_msg: types.Message, item_urls, quality: str, format_str: str,
+                               output_dir: str = None):
+    """Download batch items in parallel. Returns [(cache_key, file_id, path)] in order."""
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    results = [None] * len(item_urls)
+    done = 0
+
+    async def fetch(index, item_url):
+        nonlocal done
+        cache_key = normalize_url(item_url)
+        cached = await run_db(get_cached_file, cache_key, quality)
+        if cached:
+            results[index] = (cache_key, cached[0], None)
+        else:
+            # Own directory per item: two items with the same title must not overwrite each other
+            item_dir = os.path.join(output_dir or DOWNLOAD_DIR, f"item-{index}")
+            async with semaphore:
+                estimate, guessed = await estimate_disk_usage(item_url, quality)
+                try:
+                    reservation = await disk_budget.reserve(estimate, item_dir, guessed=guessed)
+                except NotEnoughDiskSpace as e:
+                    logging.error(f"Skipping batch item {item_url}: {e}")
+                    path = None
+                else:
+                    # Released once downloaded: the file stays until the batch is sent,
+                    # and from then on shows in the free space
+                    try:
+                        path = await download_video(item_url, format_str, work_dir=item_dir)
+                    finally:
+                        await disk_budget.release(reservation, keep=True)
+            if path and os.path.exists(path):
+                results[index] = (cache_key, None, path)
+
+        done += 1
+        progress_dispatcher.report(status_msg, "items", done, len(item_urls))
+
+    await asyncio.gather(*(fetch(i, item_url) for i, item_url in enumerate(item_urls)))
+    progress_dispatcher.clear(status_msg)
+    return [result for result in results if result]
+
+def split_media_groups(items, size: int = 10):
+    """Split items into media groups of at most `size`, as even as possible.
+
+    Groups of one only happen for a single item: 11 items make 6 + 5, not 10 + 1.
+    """
+    count = -(-len(items) // size)
+    groups = []
+    start = 0
+    for i in range(count):
+        length = len(items) // count + (i < len(items) % count)
+        groups.append(items[start:start + length])
+        start += length
+    return groups
+
+async def send_batch(message: types.Message, items, media_type: str, quality: str) -> int:
+    """Send batch items as media groups of up to 10. Returns the number sent."""
+    caption_text = get_caption_text()
+    threshold = get_large_file_threshold()
+    sent_count = 0
+    group = []
+
+    for cache_key, file_id, path in items:
+        if path and os.path.getsize(path) > threshold:
+            # Too big for the Bot API: send on its own through MTProto
+            if not uploader.is_available:
+                continue
+            try:
+                uploaded_id, uploaded_type = await uploader.upload(message.chat.id, path, media_type, caption=caption_text)
+                if cache_key and uploaded_id:
+                    await run_db(save_cached_file, cache_key, quality, uploaded_id, uploaded_type, os.path.getsize(path))
+                sent_count += 1
+            except Exception as e:
+                logging.error(f"Batch upload of {path} failed: {e}")
+            continue
+        group.append((cache_key, file_id, path))
+
+    input_media = InputMediaAudio if media_type == "audio" else InputMediaVideo
+    for chunk in split_media_groups(group):
+        media = [
+            input_media(media=file_id or FSInputFile(path), caption=caption_text if i == 0 else None)
+            for i, (_, file_id, path) in enumerate(chunk)
+        ]
+        try:
+            if len(media) == 1:
+                # A media group needs at least two items
+                send = message.answer_audio if media_type == "audio" else message.answer_video
+                sent = [await send(media[0].media, caption=caption_text, request_timeout=1200)]
+            else:
+                sent = await message.answer_media_group(media, request_timeout=1200)
+        except Exception as e:
+            logging.error(f"Sending media group failed: {e}")
+            continue
+        sent_count += len(sent)
+        for (cache_key, file_id, path), sent_message in zip(chunk, sent):
+            if cache_key and path:
+                sent_file_id, sent_type = get_sent_file(sent_message)
+                if sent_file_id:
+                    await run_db(save_cached_file, cache_key, quality, sent_file_id, sent_type, os.path.getsize(path))
+    return sent_count
+
+async def stream_and_send(message: types.Message, url: str, quality: str, cache_key: str, flight,
+                          stats: dict = None) -> bool:
+    """Upload to Telegram while yt-dlp is still downloading, without a file on disk.
+
+    Only for formats that are a single file. Returns False if nothing was
+    sent, so the caller can fall back to a regular download.
+    """
+    info = await get_video_info(url)
+    if not info or info.get('_type') in ('playlist', 'multi_video'):
+        return False
+    format_str = get_format_str(quality)
+    selected = await select_format(info, format_str)
+    if not selected or selected.get('requested_formats'):
+        return False
+
+    file_size = selected.get('filesize')
+    file_name = f"{selected.get('title') or 'video'}.{selected.get('ext') or 'mp4'}"
+    media_type = "audio" if quality == "audio" else "video"
+
+    started = time.time()
+    try:
+        file_id, media_type = await uploader.upload_stream(
+            message.chat.id, stream_video(url, format_str), file_name, media_type,
+            caption=get_caption_text(),
+            total_size=file_size,
+            progress=progress_dispatcher.callback(flight, "stream")
+        )
+    except Exception as e:
+        logging.warning(f"Streaming upload of {url} failed, falling back to download: {e}")
+        return False
+
+    logging.info(f"Streamed {url} ({quality}) to Telegram")
+    if stats is not None:
+        stats.update(upload_path="stream", upload_seconds=time.time() - started, file_size=file_size,
+                     status="done" if file_id else "failed")
+    if file_id:
+        await run_db(save_cached_file, cache_key, quality, file_id, media_type, file_size or 0)
+        flight.resolve(file_id, media_type)
+    return True
+
+async def fetch_media(url: str, quality: str, cache_key: str, flight, progress_callback, work_dir: str = None,
+                      stats: dict = None):
+    """Get the file for a yt-dlp quality, reusing the media cache when possible.
+
+    Returns its path (None on failure). Paths inside the media cache
+    belong to the cache and must not be removed by the caller.
+    """
+    info = await get_video_info(url) if (quality == "fit" or media_cache.enabled) else None
+    format_str = get_format_str(quality, info)
+    priority = get_job_priority(quality)
+    output_dir = work_dir or DOWNLOAD_DIR
+
+    file_path = None
+    key = None
+    if info and media_cache.enabled:
+        selected = await select_format(info, format_str)
+        if selected and selected.get("format_id"):
+            key = media_key(cache_key, selected["format_id"])
+            file_path = await run_db(media_cache.lookup, key)
+            MEDIA_CACHE.inc(result="hit" if file_path else "miss")
+            if file_path:
+                logging.info(f"Media cache hit: {key}")
+                if stats is not None:
+                    stats["cache_hit"] = 1
+        if not file_path and quality == "audio":
+            # Any cached rendition of the same source already has the audio track
+            for _, cached_path in await run_db(media_cache.find, cache_key):
+                file_path = await extract_audio(cached_path, output_dir, priority)
+                if file_path:
+                    logging.info(f"Audio of {cache_key} extracted from cached {cached_path}")
+                    if stats is not None:
+                        stats["cache_hit"] = 1
+                    key = None
+                    break
+
+    if not file_path:
+        download_started = time.time()
+        file_path = await download_video(url, format_str, progress_callback=progress_callback, work_dir=work_dir,
+                                         trace_id=stats.get("trace_id") if stats else None)
+        download_seconds = time.time() - download_started
+        if stats is not None:
+            stats["download_seconds"] = download_seconds
+        if not file_path or not os.path.exists(file_path):
+            return None
+
+        if quality != "audio":
+            file_path, post_stats = await make_streamable(file_path, priority)
+            logging.info(f"Download took {download_seconds:.1f}s, "
+                         f"post-processing ({post_stats['action']}) {post_stats['seconds']:.1f}s")
+        if key:
+            downloaded_path = file_path
+            try:
+                file_path = await run_db(media_cache.store, key, downloaded_path)
+            except OSError as e:
+                # Not worth failing the request: send the downloaded file as is
+                logging.error(f"Failed to store {key} in the media cache: {e}")
+            if file_path != downloaded_path:
+                # Drops the job directory, now empty
+                remove_download(downloaded_path)
 
-            if file_size > large_file_threshold:
+    if quality == "fit" and os.path.getsize(file_path) > get_large_file_threshold():
+        progress_dispatcher.clear(flight)
+        await flight.edit_text("🗜 Сжимаю видео, чтобы отправить быстрее...")
+        file_path, _ = await compress_to_size(
+            file_path, get_large_file_threshold(), priority,
+            output_dir=output_dir if media_cache.contains_path(file_path) else None
+        )
+    return file_path
+
+async def download_and_send(message: types.Message, url: str, quality: str, cache_key: str, flight,
+                            work_dir: str = None, stats: dict = None):
+    stats = stats if stats is not None else {}
+    try:
+        if quality == "spotify":
+            download_started = time.time()
+            files = await download_spotify(url, progress_dispatcher.callback(flight, "tracks"), work_dir, 1)
+            stats["download_seconds"] = time.time() - download_started
+            file_path = files[0] if files else None
+        else:
+            file_path = await fetch_media(url, quality, cache_key, flight,
+                                          progress_dispatcher.hook(flight, "download"), work_dir, stats)
+
+        if not file_path or not os.path.exists(file_path):
+            logging.error(f"Download failed: file not found at {file_path}")
+            await message.answer("Не удалось скачать файл. Возможно, он недоступен.")
+            return
+
+        # Check file size (Telegram limit ~50MB for bots)
+        file_size = os.path.getsize(file_path)
+        logging.info(f"File downloaded: {file_path}, size: {file_size} bytes")
+        use_uploader = file_size > get_large_file_threshold()
+        stats["file_size"] = file_size
+        upload_started = time.time()
+        with profile_stage("upload", stats.get("trace_id")):
+            if not use_uploader:
+                await message.answer("Загружаю видео в Telegram...")
+
+                video_file = FSInputFile(file_path)
+                try:
+                    caption_text = get_caption_text()
+
+                    # Retry logic for upload
+                    max_retries = 3
+                    for attempt in range(max_retries):
+                        try:
+                            if quality in ["audio", "spotify"]:
+                                 sent = await message.answer_audio(
+                                    video_file,
+                                    caption=f"🎧 {caption_text}",
+                                    request_timeout=1200
+                                 )
+                            else:
+                                 sent = await message.answer_video(
+                                    video_file,
+                                    caption=f"📹 {caption_text}",
+                                    supports_streaming=True,
+                                    request_timeout=1200
+                                 )
+                            break # Success
+                        except Exception as e:
+                            if uploader.is_available:
+                                # A Bot API retry resends the whole file; MTProto resumes by part
+                                logging.warning(f"Bot API upload failed: {e}. Switching to resumable upload...")
+                                use_uploader = True
+                                break
+                            if attempt == max_retries - 1:
+                                raise e
+                            logging.warning(f"Upload attempt {attempt + 1} failed: {e}. Retrying...")
+                            await asyncio.sleep(backoff_delay(attempt, base=2))
+
+                    if not use_uploader:
+                        sent_file_id, media_type = get_sent_file(sent)
+                        stats.update(status="done", upload_path="bot_api", upload_seconds=time.time() - upload_started)
+                        if sent_file_id:
+                            await run_db(save_cached_file, cache_key, quality, sent_file_id, media_type, file_size)
+                            flight.resolve(sent_file_id, media_type)
+
+                except Exception as e:
+                    await message.answer(f"Ошибка при отправке файла: {e}")
+
+            if use_uploader:
                 await message.answer(f"Файл ({file_size / 1024 / 1024:.1f} MB) большой.\n"
                                      "Скачиваю ваш файлик, чуть-чуть подожди, дорогой ...")
-                
+
                 try:
-                    # Run uploader.py as a separate process
-                    import subprocess
-                    
-                    # Use the same python interpreter
-                    python_executable = sys.executable
-                    
-                    process = await asyncio.create_subprocess_exec(
-                        python_executable, "uploader.py", str(message.chat.id), file_path,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    )
-                    
-                    # Wait for it to finish and read stdout
-                    while True:
-                        line = await process.stdout.readline()
-                        if not line:
+                    upload_progress = progress_dispatcher.callback(flight, "upload")
+                    media_type = "audio" if quality in ["audio", "spotify"] else "video"
+                    # Each retry only sends the parts Telegram does not have yet
+                    for attempt in range(UPLOAD_ATTEMPTS):
+                        try:
+                            uploaded_file_id, uploaded_media_type = await uploader.upload(
+                                message.chat.id, file_path, media_type,
+                                caption=get_caption_text(),
+                                progress=upload_progress
+                            )
                             break
-                        
-                        line_str = line.decode().strip()
-                        if "Progress:" in line_str:
-                            try:
-                                await message.edit_text(f"📤 **Загрузка в Telegram:** {line_str.split(': ')[1]}")
-                            except Exception:
-                                pass
-                    
-                    await process.wait()
-                    
-                    if process.returncode == 0:
-                        logging.info("Large file upload completed successfully via uploader.py")
-                        await message.answer("✅ Загрузка завершена!")
-                    else:
-                        stderr_data = await process.stderr.read()
-                        error_msg = stderr_data.decode().strip()
-                        logging.error(f"Uploader error: {error_msg}")
-                        await message.answer(f"Ошибка при загрузке: {error_msg}")
-                
-                except Exception as e:
-                    logging.error(f"Subprocess error: {e}")
-                    await message.answer(f"Не удалось запустить загрузчик: {e}")
-                
-                # Cleanup
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                return
+                        except Exception as e:
+                            if attempt == UPLOAD_ATTEMPTS - 1:
+                                raise
+                            logging.warning(f"Uploader attempt {attempt + 1} failed: {e}. Resuming...")
+                            await asyncio.sleep(backoff_delay(attempt, base=2))
 
-            await message.answer("Загружаю видео в Telegram...")
-            
-            video_file = FSInputFile(file_path)
-            try:
-                caption_text = f"Скачано с помощью @{BOT_USERNAME}" if BOT_USERNAME else "Скачано ботом"
-                
-                # Retry logic for upload
-                max_retries = 3
-                for attempt in range(max_retries):
-                    try:
-                        if quality in ["audio", "spotify"]:
-                             await message.answer_audio(
-                                video_file,
-                                caption=f"🎧 {caption_text}",
-                                request_timeout=1200
-                             )
-                        else:
-                             await message.answer_video(
-                                video_file,
-                                caption=f"📹 {caption_text}",
-                                supports_streaming=True,
-                                request_timeout=1200
-                             )
-                        break # Success
-                    except Exception as e:
-                        if attempt == max_retries - 1:
-                            raise e
-                        logging.warning(f"Upload attempt {attempt + 1} failed: {e}. Retrying...")
-                        await asyncio.sleep(2)
+                    logging.info("Large file upload completed successfully via uploader")
+                    stats.update(status="done", upload_path="mtproto", upload_seconds=time.time() - upload_started)
+                    if uploaded_file_id:
+                        await run_db(save_cached_file, cache_key, quality, uploaded_file_id, uploaded_media_type, file_size)
+                        flight.resolve(uploaded_file_id, uploaded_media_type)
+                    await message.answer("✅ Загрузка завершена!")
 
-            except Exception as e:
-                await message.answer(f"Ошибка при отправке файла: {e}")
-            
-            # Cleanup
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logging.info(f"Cleaned up file: {file_path}")
-        except Exception as e:
-            logging.error(f"Error processing download: {e}", exc_info=True)
-            await message.answer("Произошла ошибка при обработке видео.")
+                except Exception as e:
+                    logging.error(f"Uploader error: {e}")
+                    await message.answer(f"Ошибка при загрузке: {e}")
+
+        # Cleanup (cached files stay for the next request)
+        if not media_cache.contains_path(file_path):
+            remove_download(file_path)
+            logging.info(f"Cleaned up file: {file_path}")
+    except Exception as e:
+        logging.error(f"Error processing download: {e}", exc_info=True)
+        await message.answer("Произошла ошибка при обработке видео.")
 
 async def cleanup_downloads():
-    """Periodically clean up the downloads directory."""
+    """Periodically delete temporary files left without an owner (e.g. by a crash).
+
+    Jobs delete their own files when they end (see storage.DiskBudget),
+    so this only catches leftovers.
+    """
     while True:
         try:
-            download_dir = "downloads"
-            if os.path.exists(download_dir):
-                current_time = asyncio.get_running_loop().time()
-                for filename in os.listdir(download_dir):
-                    file_path = os.path.join(download_dir, filename)
-                    # Delete files older than 1 hour (3600 seconds)
-                    if os.path.isfile(file_path):
-                        file_age = os.path.getmtime(file_path)
-                        # Check if file is older than 1 hour
-                        import time
-                        if time.time() - file_age > 3600:
-                            try:
-                                os.remove(file_path)
-                                logging.info(f"Deleted old file: {file_path}")
-                            except Exception as e:
-                                logging.error(f"Error deleting file {file_path}: {e}")
-            
-            # Wait for 10 minutes before next check
-            await asyncio.sleep(600)
+            active_jobs = await run_db(get_active_job_ids)
+            removed = await asyncio.to_thread(disk_budget.sweep, await run_db(get_active_work_dirs), active_jobs)
+            if removed:
+                logging.info(f"Deleted {removed} leftover temporary file(s)")
         except Exception as e:
             logging.error(f"Cleanup error: {e}")
-            await asyncio.sleep(600)
+        await asyncio.sleep(600)
 
 from aiogram.types import BotCommand, BotCommandScopeChat, BotCommandScopeDefault
 
 # Global variable for bot username
 BOT_USERNAME = None
-# Semaphore to limit concurrent downloads
-download_semaphore = None
+# Persistent download queue (limits concurrent downloads); a bot-only node just queues jobs
+scheduler = JobScheduler(run_job, workers=0 if WORKER_ROLE == "bot" else DOWNLOAD_WORKERS)
 
-async def main():
-    global BOT_USERNAME, download_semaphore
-    print("Starting bot...")
+Gauge("download_workers_busy", "Download workers running a job.", function=lambda: scheduler.running)
+Gauge("in_flight_downloads", "Distinct media being downloaded.", function=lambda: len(in_flight))
+
+async def on_startup(serve_metrics: bool = True):
+    """Start everything jobs need: background writers, download workers, the uploader."""
+    global BOT_USERNAME
     logging.info("Starting bot...")
 
     # Migrate users from old file-based system (one-time)
     if os.path.exists("allowed_users.txt"):
-        migrated = migrate_from_file("allowed_users.txt")
+        migrated = await run_db(migrate_from_file, "allowed_users.txt")
         if migrated > 0:
             logging.info(f"Migrated {migrated} users from allowed_users.txt")
             # Rename old file to keep backup
             os.rename("allowed_users.txt", "allowed_users.txt.bak")
             logging.info("Renamed allowed_users.txt to allowed_users.txt.bak")
 
-    user_count = get_user_count()
+    user_count = await run_db(get_user_count)
     logging.info(f"Total allowed users in database: {user_count}")
 
-    # Initialize semaphore
-    download_semaphore = asyncio.Semaphore(5)
+    # Start the background stats writer before any job can record
+    await stats_writer.start()
+    await progress_dispatcher.start()
+
+    # Serve /metrics on its own (local by default) listener
+    if serve_metrics and METRICS_PORT:
+        try:
+            await start_metrics_server()
+        except OSError as e:
+            logging.error(f"Failed to start metrics server: {e}")
+
+    # Start download workers (resumes jobs interrupted by a restart)
+    await scheduler.start()
 
     # Start cleanup task
     asyncio.create_task(cleanup_downloads())
+
+    # Connect the MTProto uploader once and keep it warm
+    if uploader.is_available:
+        try:
+            await uploader.start()
+        except Exception as e:
+            logging.error(f"Failed to start uploader: {e}")
     
     # Get bot info
     try:
@@ -473,6 +1091,9 @@ async def main():
             [
                 BotCommand(command="start", description="Запустить бота"),
                 BotCommand(command="add", description="Добавить пользователя"),
+                BotCommand(command="queue", description="Мои загрузки в очереди"),
+                BotCommand(command="stats", description="Статистика загрузок"),
+                BotCommand(command="profiles", description="Профили медленных задач"),
                 BotCommand(command="kir", description="Получить пожелание"),
             ],
             scope=BotCommandScopeChat(chat_id=177036997)
@@ -480,9 +1101,51 @@ async def main():
     except Exception as e:
         logging.error(f"Failed to set admin commands: {e}")
 
-    # Start aiogram polling
-    print("Starting polling...")
-    await dp.start_polling(bot)
+    ready = time.perf_counter() - STARTED
+    STARTUP_SECONDS.set(ready, phase="ready")
+    logging.info(f"Bot ready in {ready:.2f}s")
+
+async def on_shutdown():
+    await uploader.stop()
+    process_pool.close()
+    await progress_dispatcher.stop()
+    await stats_writer.stop()
+    close_db()
+
+async def run_webhook():
+    """Receive updates over a webhook and handle them in background workers."""
+    await update_queue.start(bot, dp)
+    runner = await start_webhook_server()
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await update_queue.stop()
+
+async def main():
+    print("Starting bot...")
+    try:
+        await on_startup()
+        if WORKER_ROLE == "worker":
+            # Downloads only: updates are received by the bot node(s)
+            print(f"Running as download worker {WORKER_ID}...")
+            await asyncio.Event().wait()
+        elif WEBHOOK_URL:
+            print("Starting webhook...")
+            await run_webhook()
+        else:
+            # Telegram refuses getUpdates while a webhook is set
+            await bot.delete_webhook()
+            print("Starting polling...")
+            await dp.start_polling(bot)
+    finally:
+        await on_shutdown()
+
+STARTUP_SECONDS.set(time.perf_counter() - STARTED, phase="import")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,33 @@
+import asyncio
+import os
+import socket
+from typing import Optional, Tuple
+
+from database import get_cached_file, get_flight_owner, run_db
+
+# Name of this node in the shared database. Stable across restarts, so a
+# restarted node takes its own jobs back at once; replicas need distinct ids
+WORKER_ID = os.environ.get("WORKER_ID") or socket.gethostname()
+# "all": receive updates and download; "bot": only receive updates and queue jobs;
+# "worker": only run queued jobs (any number of these can share the database)
+WORKER_ROLE = os.environ.get("WORKER_ROLE", "all")
+# Seconds between heartbeats, and silence after which a node's jobs are taken over
+HEARTBEAT_INTERVAL = int(os.environ.get("HEARTBEAT_INTERVAL", 15))
+HEARTBEAT_TIMEOUT = int(os.environ.get("HEARTBEAT_TIMEOUT", 90))
+# How often a node waiting for another node's download checks on it
+FLIGHT_POLL_INTERVAL = 2
+
+
+async def wait_remote_flight(cache_key: str, quality: str) -> Optional[Tuple[str, str]]:
+    """Wait for another node downloading the same media.
+
+    Returns its (file_id, media_type), or None if it failed or stopped.
+    """
+    while True:
+        await asyncio.sleep(FLIGHT_POLL_INTERVAL)
+        cached = await run_db(get_cached_file, cache_key, quality)
+        if cached:
+            return cached
+        if not await run_db(get_flight_owner, cache_key, quality, HEARTBEAT_TIMEOUT):
+            # Saved right before it let go?
+            return await run_db(get_cached_file, cache_key, quality)
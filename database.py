@@ -1,6 +1,9 @@
+import asyncio
 import sqlite3
 import os
 import logging
+import threading
+import time
 from contextlib import contextmanager
 from typing import Optional, List, Tuple
 
@@ -16,19 +19,91 @@ def get_db_path() -> str:
     return DB_PATH
 
 
+# Journal mode of the database. WAL needs shared memory between the processes using
+# it, so it only works on one host; nodes sharing the database over a network volume
+# must use DELETE (and a filesystem with working locks)
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL")
+
+# Pragmas for the shared connection: WAL lets readers run during writes,
+# synchronous=NORMAL skips the fsync on every commit (still safe in WAL)
+PRAGMAS = (
+    f"PRAGMA journal_mode={DB_JOURNAL_MODE}",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA mmap_size=67108864",
+)
+# Seconds before the in-memory allowlist is re-read (other processes may change it)
+ALLOWLIST_TTL = int(os.environ.get("ALLOWLIST_TTL", 60))
+
+_conn = None
+_conn_lock = threading.RLock()
+_conn_depth = 0
+
+
+def _open_connection():
+    # One connection for the whole process, shared by the event loop and the
+    # download threads (serialized by _conn_lock). It keeps its compiled
+    # statements, so repeated queries are not parsed again.
+    conn = sqlite3.connect(get_db_path(), check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
 @contextmanager
 def get_connection():
-    """Context manager for database connections."""
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        conn.close()
+    """Context manager for the shared database connection.
+
+    Commits on success and rolls back on error; nested uses join the
+    outer transaction.
+    """
+    global _conn, _conn_depth
+    with _conn_lock:
+        if _conn is None:
+            _conn = _open_connection()
+        _conn_depth += 1
+        try:
+            yield _conn
+            if _conn_depth == 1:
+                _conn.commit()
+        except Exception as e:
+            if _conn_depth == 1:
+                _conn.rollback()
+            raise e
+        finally:
+            _conn_depth -= 1
+
+
+def close_db():
+    global _conn
+    with _conn_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a database function in a thread, so disk I/O never blocks the event loop."""
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+# Columns added to download_stats (name and type, as in ALTER TABLE)
+STATS_COLUMNS = (
+    "status TEXT",
+    "upload_path TEXT",
+    "cache_hit INTEGER DEFAULT 0",
+    "download_seconds REAL",
+    "upload_seconds REAL",
+    "total_seconds REAL",
+    "trace_id TEXT",
+)
+STATS_FIELDS = (
+    "user_id", "url", "platform", "quality", "file_size",
+    "status", "upload_path", "cache_hit", "download_seconds", "upload_seconds", "total_seconds", "trace_id",
+)
 
 
 def init_db():
@@ -60,14 +135,136 @@ def init_db():
             )
         """)
 
+        # Telegram file_id cache: normalized URL + quality -> already uploaded file
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS file_cache (
+                cache_key TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                media_type TEXT NOT NULL,
+                file_size INTEGER,
+                hits INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (cache_key, quality)
+            )
+        """)
+
+        # Extracted media info (JSON), spilled from the in-memory cache
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS info_cache (
+                cache_key TEXT PRIMARY KEY,
+                info_json TEXT NOT NULL,
+                stored_at REAL NOT NULL
+            )
+        """)
+
+        # Download job queue (survives restarts)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                priority INTEGER NOT NULL DEFAULT 1,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """)
+
+        # Added after the jobs table shipped: directory holding the job's partial download,
+        # and the node running the job with its last sign of life
+        for column in ("work_dir TEXT", "worker_id TEXT", "heartbeat_at REAL"):
+            try:
+                cursor.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass
+
+        # Timings and outcome of each request, added to the original stats table
+        for column in STATS_COLUMNS:
+            try:
+                cursor.execute(f"ALTER TABLE download_stats ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass
+
+        # MTProto uploads in progress, so a retry only sends the missing parts
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS uploads (
+                upload_key TEXT PRIMARY KEY,
+                file_id INTEGER NOT NULL,
+                file_size INTEGER NOT NULL,
+                started_at REAL NOT NULL
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS upload_parts (
+                upload_key TEXT NOT NULL,
+                part INTEGER NOT NULL,
+                PRIMARY KEY (upload_key, part)
+            )
+        """)
+
+        # Downloaded media kept on disk for reuse, keyed by "<video key>:<format id>"
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS media_cache (
+                cache_key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                hits INTEGER DEFAULT 0,
+                last_used REAL NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Media being downloaded by some node, so other nodes wait instead of downloading it too
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS flights (
+                cache_key TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                worker_id TEXT NOT NULL,
+                heartbeat_at REAL NOT NULL,
+                PRIMARY KEY (cache_key, quality)
+            )
+        """)
+
+        # URLs waiting for the user to pick a quality, by the token in the keyboard's callback_data
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS selections (
+                token TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+
         # Create index for faster lookups
         cursor.execute("""
             CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id)
         """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, priority, id)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_download_stats_time ON download_stats(downloaded_at, platform)
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_selections_time ON selections(created_at)
+        """)
 
         logging.info(f"Database initialized at {get_db_path()}")
 
 
+# Allowed user ids held in memory: {"users": set or None, "loaded_at": float}
+_allowlist = {"users": None, "loaded_at": 0.0}
+
+
+def invalidate_allowlist():
+    _allowlist["users"] = None
+
+
 def add_user(user_id: int, username: Optional[str] = None, added_by: str = "admin") -> bool:
     """Add a user to the allowed list. Returns True if added, False if already exists."""
     try:
@@ -77,6 +274,7 @@ def add_user(user_id: int, username: Optional[str] = None, added_by: str = "admi
                 "INSERT OR IGNORE INTO users (user_id, username, added_by) VALUES (?, ?, ?)",
                 (user_id, username, added_by)
             )
+            invalidate_allowlist()
             return cursor.rowcount > 0
     except Exception as e:
         logging.error(f"Error adding user {user_id}: {e}")
@@ -89,6 +287,7 @@ def remove_user(user_id: int) -> bool:
         with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+            invalidate_allowlist()
             return cursor.rowcount > 0
     except Exception as e:
         logging.error(f"Error removing user {user_id}: {e}")
@@ -96,15 +295,20 @@ def remove_user(user_id: int) -> bool:
 
 
 def is_user_allowed(user_id: int) -> bool:
-    """Check if a user is in the allowed list."""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
-            return cursor.fetchone() is not None
-    except Exception as e:
-        logging.error(f"Error checking user {user_id}: {e}")
-        return False
+    """Check if a user is in the allowed list (served from memory)."""
+    users = _allowlist["users"]
+    if users is None or time.monotonic() - _allowlist["loaded_at"] > ALLOWLIST_TTL:
+        try:
+            with get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT user_id FROM users")
+                users = {row["user_id"] for row in cursor.fetchall()}
+        except Exception as e:
+            logging.error(f"Error loading allowed users: {e}")
+            return False
+        _allowlist["users"] = users
+        _allowlist["loaded_at"] = time.monotonic()
+    return user_id in users
 
 
 def get_all_users() -> List[Tuple[int, Optional[str]]]:
@@ -134,17 +338,649 @@ def get_user_count() -> int:
 
 def log_download(user_id: int, url: str, platform: str, quality: str, file_size: int = 0):
     """Log a download for statistics."""
+    log_downloads([{"user_id": user_id, "url": url, "platform": platform,
+                    "quality": quality, "file_size": file_size}])
+
+
+def log_downloads(rows: List[dict]):
+    """Insert several download_stats rows in one transaction (missing fields are NULL)."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                f"""INSERT INTO download_stats ({", ".join(STATS_FIELDS)})
+                    VALUES ({", ".join("?" for _ in STATS_FIELDS)})""",
+                [tuple(row.get(field) for field in STATS_FIELDS) for row in rows]
+            )
+    except Exception as e:
+        logging.error(f"Error logging {len(rows)} download(s): {e}")
+
+
+def get_download_stats(days: int = 7) -> List[dict]:
+    """Per-platform totals and latency percentiles over the last `days` days.
+
+    Percentiles are of total_seconds (request to file sent) for
+    successful requests; throughput is downloaded bytes per second of
+    download time, cache hits excluded.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """WITH recent AS (
+                       SELECT platform, status, cache_hit, file_size, download_seconds, total_seconds
+                       FROM download_stats WHERE downloaded_at >= datetime('now', ?)
+                   ),
+                   ranked AS (
+                       SELECT platform, total_seconds,
+                              ROW_NUMBER() OVER (PARTITION BY platform ORDER BY total_seconds) AS rn,
+                              COUNT(*) OVER (PARTITION BY platform) AS cnt
+                       FROM recent WHERE status = 'done' AND total_seconds IS NOT NULL
+                   ),
+                   percentiles AS (
+                       SELECT platform,
+                              MIN(CASE WHEN rn >= 0.50 * cnt THEN total_seconds END) AS p50,
+                              MIN(CASE WHEN rn >= 0.90 * cnt THEN total_seconds END) AS p90,
+                              MIN(CASE WHEN rn >= 0.99 * cnt THEN total_seconds END) AS p99
+                       FROM ranked GROUP BY platform
+                   )
+                   SELECT r.platform,
+                          COUNT(*) AS requests,
+                          SUM(r.status = 'done') AS done,
+                          SUM(r.cache_hit) AS cache_hits,
+                          COALESCE(SUM(CASE WHEN NOT r.cache_hit THEN r.file_size END), 0) AS bytes,
+                          SUM(CASE WHEN NOT r.cache_hit AND r.download_seconds > 0
+                                   THEN r.file_size END) * 1.0
+                              / SUM(CASE WHEN NOT r.cache_hit AND r.download_seconds > 0
+                                         THEN r.download_seconds END) AS bytes_per_second,
+                          p.p50, p.p90, p.p99
+                   FROM recent r LEFT JOIN percentiles p ON p.platform = r.platform
+                   GROUP BY r.platform
+                   ORDER BY requests DESC""",
+                (f"-{int(days)} days",)
+            )
+            return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Error getting download stats: {e}")
+        return []
+
+
+def get_cached_file(cache_key: str, quality: str) -> Optional[Tuple[str, str]]:
+    """Get (file_id, media_type) of an already uploaded file, or None."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT file_id, media_type FROM file_cache WHERE cache_key = ? AND quality = ?",
+                (cache_key, quality)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute(
+                "UPDATE file_cache SET hits = hits + 1 WHERE cache_key = ? AND quality = ?",
+                (cache_key, quality)
+            )
+            return row["file_id"], row["media_type"]
+    except Exception as e:
+        logging.error(f"Error reading file cache for {cache_key}: {e}")
+        return None
+
+
+def save_cached_file(cache_key: str, quality: str, file_id: str, media_type: str, file_size: int = 0):
+    """Remember the Telegram file_id of an uploaded file."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT OR REPLACE INTO file_cache
+                   (cache_key, quality, file_id, media_type, file_size)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (cache_key, quality, file_id, media_type, file_size)
+            )
+    except Exception as e:
+        logging.error(f"Error saving file cache for {cache_key}: {e}")
+
+
+def delete_cached_file(cache_key: str, quality: str):
+    """Forget a cached file_id (e.g. Telegram no longer accepts it)."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM file_cache WHERE cache_key = ? AND quality = ?",
+                (cache_key, quality)
+            )
+    except Exception as e:
+        logging.error(f"Error deleting file cache for {cache_key}: {e}")
+
+
+def get_info_cache(cache_key: str, max_age: float) -> Optional[Tuple[float, str]]:
+    """Get (stored_at, info_json) of extracted info not older than max_age seconds."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT stored_at, info_json FROM info_cache WHERE cache_key = ? AND stored_at > ?",
+                (cache_key, time.time() - max_age)
+            )
+            row = cursor.fetchone()
+            return (row["stored_at"], row["info_json"]) if row else None
+    except Exception as e:
+        logging.error(f"Error reading info cache for {cache_key}: {e}")
+        return None
+
+
+def save_info_cache(cache_key: str, info_json: str):
+    """Store extracted info and drop expired entries."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO info_cache (cache_key, info_json, stored_at) VALUES (?, ?, ?)",
+                (cache_key, info_json, time.time())
+            )
+            cursor.execute("DELETE FROM info_cache WHERE stored_at < ?", (time.time() - 86400,))
+    except Exception as e:
+        logging.error(f"Error saving info cache for {cache_key}: {e}")
+
+
+def delete_info_cache(cache_key: str):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM info_cache WHERE cache_key = ?", (cache_key,))
+    except Exception as e:
+        logging.error(f"Error deleting info cache for {cache_key}: {e}")
+
+
+def enqueue_job(user_id: int, chat_id: int, url: str, quality: str, priority: int = 1) -> Optional[int]:
+    """Add a download job to the queue. Returns the job id."""
     try:
         with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                """INSERT INTO download_stats
-                   (user_id, url, platform, quality, file_size)
+                """INSERT INTO jobs (user_id, chat_id, url, quality, priority)
                    VALUES (?, ?, ?, ?, ?)""",
-                (user_id, url, platform, quality, file_size)
+                (user_id, chat_id, url, quality, priority)
+            )
+            return cursor.lastrowid
+    except Exception as e:
+        logging.error(f"Error enqueueing job for {user_id}: {e}")
+        return None
+
+
+# Queued jobs with their user's running job count and last start (see claim_next_job)
+QUEUED_JOBS_SQL = """SELECT j.*, COALESCE(r.running, 0) AS user_running,
+                            COALESCE(r.last_started, '') AS user_last_started
+                     FROM jobs j
+                     LEFT JOIN (SELECT user_id,
+                                       SUM(status = 'running') AS running,
+                                       MAX(started_at) AS last_started
+                                FROM jobs WHERE status != 'queued' GROUP BY user_id) r
+                            ON r.user_id = j.user_id
+                     WHERE j.status = 'queued'"""
+# Order queued jobs are served in
+QUEUE_ORDER = ("user_running", "priority", "user_last_started", "id")
+
+
+def claim_next_job(max_per_user: int, worker_id: str = None) -> Optional[dict]:
+    """Mark the next queued job as running on worker_id and return it.
+
+    Users with fewer running jobs (on any node) go first, then lower
+    priority values, then the user served least recently (round robin),
+    then older jobs. Users already running max_per_user jobs are skipped.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""SELECT id, user_id, chat_id, url, quality, priority, attempts, created_at
+                    FROM ({QUEUED_JOBS_SQL})
+                    WHERE user_running < ?
+                    ORDER BY {", ".join(QUEUE_ORDER)}
+                    LIMIT 1""",
+                (max_per_user,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute(
+                """UPDATE jobs SET status = 'running', started_at = strftime('%Y-%m-%d %H:%M:%f', 'now'),
+                   attempts = attempts + 1, worker_id = ?, heartbeat_at = ?
+                   WHERE id = ? AND status = 'queued'""",
+                (worker_id, time.time(), row["id"])
+            )
+            if cursor.rowcount == 0:
+                return None
+            return dict(row)
+    except Exception as e:
+        logging.error(f"Error claiming job: {e}")
+        return None
+
+
+def finish_job(job_id: int, status: str = "done"):
+    """Mark a job as done or failed."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (status, job_id)
+            )
+    except Exception as e:
+        logging.error(f"Error finishing job {job_id}: {e}")
+
+
+def get_queue_position(job_id: int) -> int:
+    """Number of queued jobs ahead of this one (0 if it is next or not queued).
+
+    Counted in the order claim_next_job serves them, as things stand now.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            other = ", ".join(f"o.{column}" for column in QUEUE_ORDER)
+            this = ", ".join(f"j.{column}" for column in QUEUE_ORDER)
+            cursor.execute(
+                f"""WITH q AS ({QUEUED_JOBS_SQL})
+                    SELECT COUNT(*) AS ahead FROM q o, q j
+                    WHERE j.id = ? AND ({other}) < ({this})""",
+                (job_id,)
+            )
+            row = cursor.fetchone()
+            return row["ahead"] if row else 0
+    except Exception as e:
+        logging.error(f"Error getting queue position of job {job_id}: {e}")
+        return 0
+
+
+def get_user_jobs(user_id: int) -> List[dict]:
+    """Queued and running jobs of a user."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT id, url, quality, status FROM jobs
+                   WHERE user_id = ? AND status IN ('queued', 'running') ORDER BY id""",
+                (user_id,)
+            )
+            return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Error getting jobs of user {user_id}: {e}")
+        return []
+
+
+def requeue_interrupted_jobs(stale_after: float, worker_id: str = None, max_attempts: int = 3) -> int:
+    """Put jobs left running by a crash back in the queue. Returns their count.
+
+    A running job is interrupted if it belongs to worker_id (this node,
+    restarted) or its node sent no heartbeat for stale_after seconds.
+    Jobs that already failed max_attempts times are marked failed instead.
+    Finished jobs older than a week are removed.
+    """
+    interrupted = "status = 'running' AND (worker_id IS ? OR heartbeat_at IS NULL OR heartbeat_at < ?)"
+    params = (worker_id, time.time() - stale_after)
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = CURRENT_TIMESTAMP "
+                f"WHERE {interrupted} AND attempts >= ?",
+                params + (max_attempts,)
             )
+            cursor.execute(f"UPDATE jobs SET status = 'queued', worker_id = NULL WHERE {interrupted}", params)
+            requeued = cursor.rowcount
+            cursor.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') "
+                "AND finished_at < datetime('now', '-7 days')"
+            )
+            return requeued
+    except Exception as e:
+        logging.error(f"Error requeueing jobs: {e}")
+        return 0
+
+
+def touch_worker(worker_id: str):
+    """Heartbeat: mark the running jobs and downloads of a node as alive."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            now = time.time()
+            cursor.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE worker_id = ? AND status = 'running'",
+                (now, worker_id)
+            )
+            cursor.execute("UPDATE flights SET heartbeat_at = ? WHERE worker_id = ?", (now, worker_id))
+    except Exception as e:
+        logging.error(f"Error updating heartbeat of {worker_id}: {e}")
+
+
+def set_job_work_dir(job_id: int, work_dir: str):
+    """Remember where a job keeps its partial download."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE jobs SET work_dir = ? WHERE id = ?", (work_dir, job_id))
+    except Exception as e:
+        logging.error(f"Error setting work dir of job {job_id}: {e}")
+
+
+def get_job_work_dir(job_id: int) -> Optional[str]:
+    """Directory a job used on an earlier attempt, if any."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT work_dir FROM jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            return row["work_dir"] if row else None
+    except Exception as e:
+        logging.error(f"Error getting work dir of job {job_id}: {e}")
+        return None
+
+
+def get_active_work_dirs() -> List[str]:
+    """Work directories of queued and running jobs (must not be cleaned up)."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT work_dir FROM jobs WHERE status IN ('queued', 'running') AND work_dir IS NOT NULL"
+            )
+            return [row["work_dir"] for row in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Error getting active work dirs: {e}")
+        return []
+
+
+def get_pending_job_ids(worker_id: str) -> Optional[List[int]]:
+    """Ids of jobs still waiting for a worker, or running on worker_id (None on error)."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' OR (status = 'running' AND worker_id = ?)",
+                (worker_id,)
+            )
+            return [row["id"] for row in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Error getting pending jobs: {e}")
+        return None
+
+
+def get_active_job_ids() -> List[int]:
+    """Ids of queued and running jobs, including ones that have not recorded a work dir yet."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM jobs WHERE status IN ('queued', 'running')")
+            return [row["id"] for row in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Error getting active jobs: {e}")
+        return []
+
+
+def claim_flight(cache_key: str, quality: str, worker_id: str, stale_after: float) -> bool:
+    """Take the right to download a media for worker_id.
+
+    Returns False while another node holds it and keeps it alive.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """DELETE FROM flights WHERE cache_key = ? AND quality = ?
+                   AND (worker_id = ? OR heartbeat_at < ?)""",
+                (cache_key, quality, worker_id, time.time() - stale_after)
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO flights (cache_key, quality, worker_id, heartbeat_at) VALUES (?, ?, ?, ?)",
+                (cache_key, quality, worker_id, time.time())
+            )
+            return cursor.rowcount > 0
+    except Exception as e:
+        logging.error(f"Error claiming flight {cache_key}: {e}")
+        # Better a duplicate download than none
+        return True
+
+
+def get_flight_owner(cache_key: str, quality: str, stale_after: float) -> Optional[str]:
+    """Node currently downloading a media, or None."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT worker_id FROM flights WHERE cache_key = ? AND quality = ? AND heartbeat_at >= ?",
+                (cache_key, quality, time.time() - stale_after)
+            )
+            row = cursor.fetchone()
+            return row["worker_id"] if row else None
+    except Exception as e:
+        logging.error(f"Error reading flight {cache_key}: {e}")
+        return None
+
+
+def release_flight(cache_key: str, quality: str, worker_id: str):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM flights WHERE cache_key = ? AND quality = ? AND worker_id = ?",
+                (cache_key, quality, worker_id)
+            )
+    except Exception as e:
+        logging.error(f"Error releasing flight {cache_key}: {e}")
+
+
+def release_worker_flights(worker_id: str):
+    """Drop the downloads a node left behind when it stopped."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM flights WHERE worker_id = ?", (worker_id,))
+    except Exception as e:
+        logging.error(f"Error releasing flights of {worker_id}: {e}")
+
+
+def save_selection(token: str, user_id: int, url: str, max_age: float, max_count: int) -> bool:
+    """Store a URL waiting for a quality choice.
+
+    Selections older than max_age are dropped, and the oldest ones beyond
+    max_count, so the table stays bounded however many links are sent.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO selections (token, user_id, url, created_at) VALUES (?, ?, ?, ?)",
+                (token, user_id, url, time.time())
+            )
+            cursor.execute("DELETE FROM selections WHERE created_at < ?", (time.time() - max_age,))
+            cursor.execute(
+                """DELETE FROM selections WHERE token IN
+                   (SELECT token FROM selections ORDER BY created_at DESC LIMIT -1 OFFSET ?)""",
+                (max_count,)
+            )
+            return True
+    except Exception as e:
+        logging.error(f"Error saving selection for {user_id}: {e}")
+        return False
+
+
+def get_selection(token: str, max_age: float) -> Optional[Tuple[int, str]]:
+    """(user_id, url) of a pending selection, or None if it was chosen or expired."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT user_id, url FROM selections WHERE token = ? AND created_at >= ?",
+                (token, time.time() - max_age)
+            )
+            row = cursor.fetchone()
+            return (row["user_id"], row["url"]) if row else None
+    except Exception as e:
+        logging.error(f"Error reading selection {token}: {e}")
+        return None
+
+
+def delete_selection(token: str) -> bool:
+    """Remove a selection once chosen. Returns False if it was already gone (a double click)."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM selections WHERE token = ?", (token,))
+            return cursor.rowcount > 0
+    except Exception as e:
+        logging.error(f"Error deleting selection {token}: {e}")
+        return False
+
+
+def get_upload(upload_key: str, max_age: float) -> Optional[Tuple[int, int, set]]:
+    """Return (file_id, file_size, uploaded parts) of an unfinished upload.
+
+    Uploads older than max_age seconds are dropped: Telegram forgets
+    uploaded parts after a while.
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT file_id, file_size, started_at FROM uploads WHERE upload_key = ?",
+                (upload_key,)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            if time.time() - row["started_at"] > max_age:
+                cursor.execute("DELETE FROM uploads WHERE upload_key = ?", (upload_key,))
+                cursor.execute("DELETE FROM upload_parts WHERE upload_key = ?", (upload_key,))
+                return None
+            cursor.execute("SELECT part FROM upload_parts WHERE upload_key = ?", (upload_key,))
+            return row["file_id"], row["file_size"], {r["part"] for r in cursor.fetchall()}
+    except Exception as e:
+        logging.error(f"Error getting upload {upload_key}: {e}")
+        return None
+
+
+def start_upload(upload_key: str, file_id: int, file_size: int):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM upload_parts WHERE upload_key = ?", (upload_key,))
+            cursor.execute(
+                "INSERT OR REPLACE INTO uploads (upload_key, file_id, file_size, started_at) VALUES (?, ?, ?, ?)",
+                (upload_key, file_id, file_size, time.time())
+            )
+    except Exception as e:
+        logging.error(f"Error starting upload {upload_key}: {e}")
+
+
+def mark_parts_uploaded(upload_key: str, parts: List[int]):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "INSERT OR IGNORE INTO upload_parts (upload_key, part) VALUES (?, ?)",
+                [(upload_key, part) for part in parts]
+            )
+    except Exception as e:
+        logging.error(f"Error saving {len(parts)} parts of upload {upload_key}: {e}")
+
+
+def delete_upload(upload_key: str):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM uploads WHERE upload_key = ?", (upload_key,))
+            cursor.execute("DELETE FROM upload_parts WHERE upload_key = ?", (upload_key,))
+    except Exception as e:
+        logging.error(f"Error deleting upload {upload_key}: {e}")
+
+
+def get_media_entry(cache_key: str) -> Optional[str]:
+    """Return the path of a cached download and mark it as used."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT path FROM media_cache WHERE cache_key = ?", (cache_key,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute(
+                "UPDATE media_cache SET hits = hits + 1, last_used = ? WHERE cache_key = ?",
+                (time.time(), cache_key)
+            )
+            return row["path"]
+    except Exception as e:
+        logging.error(f"Error getting cached media {cache_key}: {e}")
+        return None
+
+
+def find_media_entries(key_prefix: str) -> List[Tuple[str, str]]:
+    """All (cache_key, path) of cached downloads whose key starts with key_prefix."""
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT cache_key, path FROM media_cache WHERE substr(cache_key, 1, ?) = ? ORDER BY last_used DESC",
+                (len(key_prefix), key_prefix)
+            )
+            return [(row["cache_key"], row["path"]) for row in cursor.fetchall()]
+    except Exception as e:
+        logging.error(f"Error finding cached media {key_prefix}: {e}")
+        return []
+
+
+def save_media_entry(cache_key: str, path: str, size: int):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT OR REPLACE INTO media_cache (cache_key, path, size, hits, last_used)
+                   VALUES (?, ?, ?, 0, ?)""",
+                (cache_key, path, size, time.time())
+            )
+    except Exception as e:
+        logging.error(f"Error saving cached media {cache_key}: {e}")
+
+
+def delete_media_entry(cache_key: str):
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM media_cache WHERE cache_key = ?", (cache_key,))
+    except Exception as e:
+        logging.error(f"Error deleting cached media {cache_key}: {e}")
+
+
+def get_media_cache_size() -> int:
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COALESCE(SUM(size), 0) AS total FROM media_cache")
+            return cursor.fetchone()["total"]
+    except Exception as e:
+        logging.error(f"Error getting media cache size: {e}")
+        return 0
+
+
+def get_media_eviction_order(used_before: float) -> List[Tuple[str, str, int]]:
+    """(cache_key, path, size) of cached downloads, least recently (then least often) used first.
+
+    Entries used after used_before are left out (they may be being sent).
+    """
+    try:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """SELECT cache_key, path, size FROM media_cache WHERE last_used < ?
+                   ORDER BY last_used, hits""",
+                (used_before,)
+            )
+            return [(row["cache_key"], row["path"], row["size"]) for row in cursor.fetchall()]
     except Exception as e:
-        logging.error(f"Error logging download: {e}")
+        logging.error(f"Error listing cached media: {e}")
+        return []
 
 
 def migrate_from_file(file_path: str = "allowed_users.txt") -> int:
@@ -0,0 +1,45 @@
+import sys
+import json
+
+from downloader import download_video_sync
+
+# Progress fields forwarded to the bot (the full hook dict is not serializable)
+PROGRESS_KEYS = (
+    'status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate',
+    'speed', 'eta', 'elapsed', '_percent_str', '_speed_str', '_eta_str',
+)
+
+
+# Events go to the real stdout; anything else printed (yt-dlp output,
+# error prints) is sent to stderr so it cannot corrupt an event line
+events_out = sys.stdout
+sys.stdout = sys.stderr
+
+
+def emit(event):
+    events_out.write(json.dumps(event) + "\n")
+    events_out.flush()
+
+
+def main():
+    # One JSON job per line: {"url": ..., "format_str": ..., "info": ..., "work_dir": ..., "trace_id": ...}
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+
+        def relay(d):
+            emit({'event': 'progress', 'data': {k: d.get(k) for k in PROGRESS_KEYS}})
+
+        try:
+            path = download_video_sync(job['url'], job.get('format_str'), None, relay,
+                                       info=job.get('info'), work_dir=job.get('work_dir'),
+                                       trace_id=job.get('trace_id'))
+        except Exception as e:
+            print(f"Error downloading: {e}")
+            path = None
+        emit({'event': 'result', 'path': path})
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,23 @@
 import yt_dlp
 import os
+import logging
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import sys
-import subprocess
 import glob
+import re
+import copy
+import json
+import time
+import threading
+import tempfile
+from collections import OrderedDict
+from segmented import SegmentedYoutubeDL, SEGMENTED_CONNECTIONS
+from ydl_pool import ydl_pool, install_dns_cache
+from retry import backoff_delay
+from metrics import INFO_CACHE, EXTRACT_SECONDS
+from profiling import profile_stage
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
 # Create a downloads directory if it doesn't exist
 if os.environ.get("VERCEL"):
@@ -16,29 +29,406 @@ else:
 
 executor = ThreadPoolExecutor(max_workers=5)
 
+# Repeated jobs hit the same CDN hosts
+install_dns_cache()
+
+# "thread" runs yt-dlp downloads inside the bot process, "process" in separate worker
+# processes. Info extraction and format selection stay in the executor either way: they
+# are short and mostly wait on the network, and the quality prompt must not queue behind
+# downloads that hold every worker process for minutes
+DOWNLOAD_WORKER_MODE = os.environ.get("DOWNLOAD_WORKER_MODE", "thread")
+DOWNLOAD_PROCESSES = int(os.environ.get("DOWNLOAD_PROCESSES", os.cpu_count() or 2))
+# Worker processes running longer than this are killed (process mode only)
+DOWNLOAD_TIMEOUT = int(os.environ.get("DOWNLOAD_TIMEOUT", 1800))
+# Attempts per download; retries continue from the .part files left behind
+DOWNLOAD_ATTEMPTS = int(os.environ.get("DOWNLOAD_ATTEMPTS", 3))
+
+# spotDL is killed after this many seconds without output
+SPOTIFY_TIMEOUT = int(os.environ.get("SPOTIFY_TIMEOUT", 300))
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.flac', '.opus', '.ogg')
+SPOTDL_FOUND_RE = re.compile(r'Found (\d+) songs?')
+
+# Extracted info is reused for this long (format URLs expire after a few hours)
+INFO_CACHE_TTL = int(os.environ.get("INFO_CACHE_TTL", 1800))
+INFO_CACHE_SIZE = int(os.environ.get("INFO_CACHE_SIZE", 256))
+# Also keep extracted info in SQLite so it survives restarts
+INFO_CACHE_SQLITE = os.environ.get("INFO_CACHE_SQLITE", "0") == "1"
+
+YOUTUBE_ID_RE = re.compile(r'(?:v=|youtu\.be/|/shorts/|/embed/|/live/)([0-9A-Za-z_-]{11})')
+INSTAGRAM_ID_RE = re.compile(r'instagram\.com/(?:[^/]+/)?(?:p|reel|reels|tv)/([0-9A-Za-z_-]+)')
+SPOTIFY_ID_RE = re.compile(r'spotify\.com/(?:intl-[a-z]+/)?(track|album|playlist|artist)/([0-9A-Za-z]+)')
+
+
+def normalize_url(url):
+    """Reduce a URL to a stable key, so that different links to the same media match."""
+    url = url.strip()
+
+    match = YOUTUBE_ID_RE.search(url)
+    if match and ("youtube.com" in url or "youtu.be" in url):
+        return f"youtube:{match.group(1)}"
+
+    match = INSTAGRAM_ID_RE.search(url)
+    if match:
+        return f"instagram:{match.group(1)}"
+
+    match = SPOTIFY_ID_RE.search(url)
+    if match:
+        return f"spotify:{match.group(1)}:{match.group(2)}"
+
+    # Generic URL: drop fragment and tracking parameters
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if not k.startswith("utm_")]
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip("/"), urlencode(query), ""))
+
+class InfoCache:
+    """LRU cache of extracted info dicts with a TTL, keyed by normalized URL.
+
+    Entries are sanitized (JSON-safe) info dicts, which yt-dlp can process
+    again with process_ie_result() instead of extracting from scratch.
+    """
+
+    def __init__(self, max_entries=INFO_CACHE_SIZE, ttl=INFO_CACHE_TTL, persist=INFO_CACHE_SQLITE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist = persist
+        self._entries = OrderedDict()  # key -> (stored_at, info)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a copy of the cached info, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                return copy.deepcopy(entry[1])
+            if entry:
+                del self._entries[key]
+
+        if self.persist:
+            from database import get_info_cache
+            stored = get_info_cache(key, self.ttl)
+            if stored:
+                stored_at, info_json = stored
+                info = json.loads(info_json)
+                self._remember(key, info, stored_at)
+                return copy.deepcopy(info)
+        return None
+
+    def put(self, key, info):
+        self._remember(key, info, time.time())
+        if self.persist:
+            from database import save_info_cache
+            save_info_cache(key, json.dumps(info))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.persist:
+            from database import delete_info_cache
+            delete_info_cache(key)
+
+    def _remember(self, key, info, stored_at):
+        with self._lock:
+            self._entries[key] = (stored_at, info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+info_cache = InfoCache()
+
+
 def get_video_info_sync(url):
+    key = normalize_url(url)
+    info = info_cache.get(key)
+    if info:
+        INFO_CACHE.inc(result="hit")
+        return info
+    INFO_CACHE.inc(result="miss")
+
     ydl_opts = {
         'quiet': True,
         'no_warnings': True,
     }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    with ydl_pool.lease(ydl_opts) as ydl:
         try:
-            info = ydl.extract_info(url, download=False)
+            with EXTRACT_SECONDS.time(platform=get_platform(url)):
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+            info_cache.put(key, info)
             return info
         except Exception as e:
-            print(f"Error extracting info: {e}")
+            logging.error(f"Error extracting info: {e}")
             return None
 
+# Extractions in progress: {normalized url: future}
+_info_tasks = {}
+
 async def get_video_info(url):
+    """Extract info in the executor; concurrent calls for the same URL share one extraction."""
+    key = normalize_url(url)
+    task = _info_tasks.get(key)
+    if task is None:
+        loop = asyncio.get_event_loop()
+        task = loop.run_in_executor(executor, get_video_info_sync, url)
+        _info_tasks[key] = task
+        task.add_done_callback(lambda _: _info_tasks.pop(key, None))
+    return await asyncio.shield(task)
+
+def format_size(f):
+    """Exact or approximate size of a format in bytes (None if unknown)."""
+    return f.get('filesize') or f.get('filesize_approx')
+
+
+def pick_format_under(info, max_bytes, allow_merge=True):
+    """Choose the best format (or video+audio pair) expected to fit in max_bytes.
+
+    Returns (format_str, height, estimated_bytes), or None when no
+    format with a known size fits. H.264 video with M4A audio is
+    preferred at equal height, since it needs no re-encoding for Telegram.
+    Without allow_merge (no ffmpeg) only formats with both streams count.
+    """
+    formats = info.get('formats') or []
+    candidates = []
+    audios = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+              and format_size(f)]
+    for f in formats:
+        if f.get('vcodec') in (None, 'none') or not f.get('height') or not format_size(f):
+            continue
+        avc = (f.get('vcodec') or '').startswith('avc1')
+        if f.get('acodec') not in (None, 'none'):
+            candidates.append((f['height'], avc, format_size(f), f['format_id']))
+        elif allow_merge:
+            for a in audios:
+                total = format_size(f) + format_size(a)
+                m4a = a.get('ext') == 'm4a'
+                candidates.append((f['height'], avc and m4a, total, f"{f['format_id']}+{a['format_id']}"))
+
+    fitting = [c for c in candidates if c[2] <= max_bytes]
+    if not fitting:
+        return None
+    # Highest height, then Telegram-friendly codecs, then the biggest (best bitrate) that fits
+    height, _, total, format_str = max(fitting, key=lambda c: (c[0], c[1], c[2]))
+    return format_str, height, total
+
+
+def get_quality_options(info, heights=(1080, 720, 480, 360)):
+    """List (height, estimated_bytes) for the heights a video actually offers.
+
+    Heights are capped to the best available one; bytes is None when
+    the extractor gives no (approximate) file sizes.
+    """
+    formats = info.get('formats') or []
+    videos = [f for f in formats if f.get('vcodec') not in (None, 'none') and f.get('height')]
+    audios = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    if not videos:
+        return []
+
+    size = format_size
+    best_audio = max(audios, key=lambda f: f.get('abr') or 0, default=None)
+    options = []
+    seen = set()
+    for target in heights:
+        candidates = [f for f in videos if f['height'] <= target]
+        if not candidates:
+            continue
+        height = max(f['height'] for f in candidates)
+        if height in seen:
+            continue
+        seen.add(height)
+        best = max((f for f in candidates if f['height'] == height),
+                   key=lambda f: (f.get('tbr') or 0))
+        total = size(best)
+        if total and best.get('acodec') == 'none' and best_audio:
+            audio_size = size(best_audio)
+            total = total + audio_size if audio_size else None
+        options.append((height, total))
+    return options
+
+PLATFORMS = (
+    ("youtube", ("youtube.com", "youtu.be")),
+    ("instagram", ("instagram.com",)),
+    ("spotify", ("spotify.com",)),
+    ("tiktok", ("tiktok.com",)),
+)
+
+
+def get_platform(url: str) -> str:
+    for name, domains in PLATFORMS:
+        if any(domain in url for domain in domains):
+            return name
+    return "other"
+
+
+YOUTUBE_COLLECTION_RE = re.compile(r'youtube\.com/(?:playlist\?|channel/|c/|@)')
+
+
+def is_collection_url(url):
+    """True for links that may hold several items (playlists, albums, carousels)."""
+    if "youtube.com" in url or "youtu.be" in url:
+        # watch?v=...&list=... is one video opened from a playlist
+        return bool(YOUTUBE_COLLECTION_RE.search(url)) or ("list=" in url and "v=" not in url)
+    match = SPOTIFY_ID_RE.search(url)
+    if match:
+        return match.group(1) in ("album", "playlist", "artist")
+    return bool(re.search(r'instagram\.com/(?:[^/]+/)?p/', url))
+
+def _is_nested_collection(entry):
+    return entry.get('_type') == 'playlist' or is_collection_url(entry.get('url') or '')
+
+def expand_collection_sync(url, limit, _nested=False):
+    """List the items of a collection without extracting each of them.
+
+    Returns None if the URL is a single item (its info is then cached),
+    otherwise (title, item_urls). item_urls is empty when the items cannot
+    be fetched one by one (e.g. Instagram carousels), and None when it only
+    holds other collections. Those are skipped: downloading one would
+    ignore the limit. A channel, which only lists its tabs (Videos,
+    Shorts, Live), is expanded through its first tab.
+    """
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'playlistend': limit,
+    }
+    with ydl_pool.lease(ydl_opts) as ydl:
+        try:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        except Exception as e:
+            logging.error(f"Error expanding collection: {e}")
+            return None
+
+    if info.get('_type') not in ('playlist', 'multi_video'):
+        info_cache.put(normalize_url(url), info)
+        return None
+
+    entries = [e for e in info.get('entries') or [] if e]
+    nested = [e for e in entries if _is_nested_collection(e)]
+    if nested and len(nested) == len(entries) and not _nested:
+        expanded = expand_collection_sync(nested[0]['url'], limit, _nested=True)
+        if expanded is not None:
+            return info.get('title') or expanded[0], expanded[1]
+    entries = [e for e in entries if not _is_nested_collection(e)][:limit]
+    if nested and not entries:
+        return info.get('title') or "", None
+    urls = [e.get('url') or e.get('webpage_url') for e in entries]
+    if not all(urls) or len(set(urls)) < len(urls):
+        urls = []
+    return info.get('title') or "", urls
+
+async def expand_collection(url, limit):
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, get_video_info_sync, url)
+    return await loop.run_in_executor(executor, expand_collection_sync, url, limit)
 
-def download_video_sync(url, format_str=None, output_filename=None, progress_callback=None):
+def download_collection_sync(url, format_str, limit, output_dir=None):
+    """Download every entry of a collection in one yt-dlp run. Returns the file paths."""
     ydl_opts = {
-        'outtmpl': os.path.join(DOWNLOAD_DIR, '%(title)s.%(ext)s'),
+        'outtmpl': os.path.join(output_dir or DOWNLOAD_DIR, '%(title).80s-%(id)s.%(ext)s'),
         'quiet': True,
         'no_warnings': True,
         'merge_output_format': 'mp4',
+        'format': format_str or 'best',
+        'playlistend': limit,
+    }
+    with ydl_pool.lease(ydl_opts, cls=SegmentedYoutubeDL) as ydl:
+        try:
+            info = ydl.extract_info(url, download=True)
+        except Exception as e:
+            logging.error(f"Error downloading collection: {e}")
+            return []
+
+    paths = []
+    for entry in info.get('entries') or [info]:
+        for download in (entry or {}).get('requested_downloads') or []:
+            if download.get('filepath'):
+                paths.append(download['filepath'])
+    return paths
+
+async def download_collection(url, format_str=None, limit=20, output_dir=None):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, download_collection_sync, url, format_str, limit, output_dir)
+
+def select_format_sync(info, format_str):
+    """Resolve which format(s) yt-dlp would pick, without downloading.
+
+    The result has the selected format's fields (format_id, ext, filesize...)
+    and 'requested_formats' when several streams would be merged.
+    """
+    with ydl_pool.lease({'quiet': True, 'no_warnings': True, 'format': format_str}) as ydl:
+        try:
+            return ydl.process_ie_result(copy.deepcopy(info), download=False)
+        except Exception as e:
+            logging.error(f"Error selecting format: {e}")
+            return None
+
+async def select_format(info, format_str):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, select_format_sync, info, format_str)
+
+async def stream_video(url, format_str, chunk_size=256 * 1024):
+    """Yield the media bytes while yt-dlp downloads them, without a file on disk.
+
+    Only works for formats that are a single file (no merging).
+    """
+    cmd = [sys.executable, "-m", "yt_dlp", "--quiet", "--no-warnings", "-f", format_str, "-o", "-"]
+    info = await asyncio.to_thread(info_cache.get, normalize_url(url))
+    info_path = None
+    if info:
+        # Reuse extracted info instead of extracting again in the subprocess
+        # Not in a job directory: streaming reserves no disk, and this file is tiny
+        fd, info_path = tempfile.mkstemp(suffix=".info.json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(info, f)
+        cmd += ["--load-info-json", info_path]
+    else:
+        cmd.append(url)
+
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        while True:
+            chunk = await process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        await process.wait()
+        if process.returncode != 0:
+            raise RuntimeError(f"yt-dlp exited with code {process.returncode}")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        if info_path and os.path.exists(info_path):
+            os.remove(info_path)
+
+def run_download(ydl, url, info=None):
+    """Download with an existing YoutubeDL. Reuses extracted info when given."""
+    if info:
+        info = ydl.process_ie_result(info, download=True)
+    else:
+        info = ydl.extract_info(url, download=True)
+    return ydl.prepare_filename(info)
+
+def download_video_sync(url, format_str=None, output_filename=None, progress_callback=None, info=None,
+                        work_dir=None, trace_id=None):
+    with profile_stage("download", trace_id):
+        return _download_video_sync(url, format_str, output_filename, progress_callback, info, work_dir)
+
+def _download_video_sync(url, format_str, output_filename, progress_callback, info, work_dir):
+    # A job keeps its own directory so a retry finds its .part files again
+    output_dir = work_dir or DOWNLOAD_DIR
+    if work_dir:
+        os.makedirs(work_dir, exist_ok=True)
+    ydl_opts = {
+        'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
+        'quiet': True,
+        'no_warnings': True,
+        'merge_output_format': 'mp4',
+        # Parallel fragments for DASH/HLS; plain HTTP uses SegmentedHttpFD
+        'concurrent_fragment_downloads': SEGMENTED_CONNECTIONS,
     }
     
     if format_str:
@@ -48,7 +438,7 @@ def download_video_sync(url, format_str=None, output_filename=None, progress_cal
 
     # If output_filename is provided, use it (useful for temp names)
     if output_filename:
-        ydl_opts['outtmpl'] = os.path.join(DOWNLOAD_DIR, output_filename)
+        ydl_opts['outtmpl'] = os.path.join(output_dir, output_filename)
 
     # Add progress hook
     def my_hook(d):
@@ -56,79 +446,268 @@ def download_video_sync(url, format_str=None, output_filename=None, progress_cal
             if progress_callback:
                 progress_callback(d)
 
-    if progress_callback:
-        ydl_opts['progress_hooks'] = [my_hook]
+    hook = my_hook if progress_callback else None
+
+    # Reuse info already extracted for the quality prompt, if still fresh
+    key = normalize_url(url)
+    info = info or info_cache.get(key)
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    with ydl_pool.lease(ydl_opts, hook, cls=SegmentedYoutubeDL) as ydl:
         try:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            return filename
+            try:
+                return run_download(ydl, url, info)
+            except yt_dlp.utils.DownloadError as e:
+                if not info or "ffmpeg is not installed" in str(e):
+                    raise
+                # Cached format URLs may have expired: extract again
+                logging.warning(f"Cached info failed ({e}), extracting again.")
+                info_cache.invalidate(key)
+                info = None
+                return run_download(ydl, url)
         except yt_dlp.utils.DownloadError as e:
             if "ffmpeg is not installed" in str(e):
-                print("FFmpeg not found. Falling back to 'best' format (single file).")
+                logging.warning("FFmpeg not found. Falling back to 'best' format (single file).")
                 # Remove merge option and use 'best'
                 if 'merge_output_format' in ydl_opts:
                     del ydl_opts['merge_output_format']
                 ydl_opts['format'] = 'best'
                 
                 # Retry with new options
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl_fallback:
-                    info = ydl_fallback.extract_info(url, download=True)
-                    filename = ydl_fallback.prepare_filename(info)
-                    return filename
+                with ydl_pool.lease(ydl_opts, hook, cls=SegmentedYoutubeDL) as ydl_fallback:
+                    return run_download(ydl_fallback, url, info_cache.get(key))
             else:
-                print(f"Error downloading: {e}")
+                logging.error(f"Error downloading: {e}")
+                return None
+        except Exception as e:
+            logging.error(f"Error downloading: {e}")
+            return None
+
+class WorkerProcess:
+    """One download_worker.py process. Jobs go in as JSON lines on stdin,
+    progress and results come back as JSON lines on stdout."""
+
+    def __init__(self):
+        self.process = None
+
+    @property
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, "-u", "download_worker.py",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE
+        )
+
+    def kill(self):
+        if self.is_alive:
+            self.process.kill()
+
+    async def stop(self):
+        """Kill the process and reap it: until then its returncode stays None."""
+        self.kill()
+        if self.process is not None:
+            await self.process.wait()
+
+    async def run(self, job, progress_callback=None, timeout=DOWNLOAD_TIMEOUT):
+        """Run one job. Returns the downloaded file path or None."""
+        if not self.is_alive:
+            await self.start()
+
+        try:
+            self.process.stdin.write((json.dumps(job) + "\n").encode())
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # Died while idle (e.g. out of memory) before it was reaped: start a new one
+            await self.stop()
+            await self.start()
+            self.process.stdin.write((json.dumps(job) + "\n").encode())
+            await self.process.stdin.drain()
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logging.warning(f"Download worker timed out after {timeout}s, killing it.")
+                await self.stop()
+                return None
+            try:
+                line = await asyncio.wait_for(self.process.stdout.readline(), remaining)
+            except asyncio.TimeoutError:
+                continue
+            if not line:
+                logging.error("Download worker exited unexpectedly.")
+                await self.stop()
                 return None
+
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+
+            if event.get('event') == 'progress':
+                if progress_callback:
+                    progress_callback(event['data'])
+            elif event.get('event') == 'result':
+                return event.get('path')
+
+
+class ProcessPool:
+    """Up to `size` long-lived download worker processes.
+
+    Each worker keeps yt-dlp imported between jobs, runs outside the bot's
+    GIL, and is killed (and later replaced) when a job exceeds its timeout.
+    """
+
+    def __init__(self, size=DOWNLOAD_PROCESSES):
+        self.size = size
+        self._created = 0
+        self._idle = None
+
+    async def _acquire(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        if self._idle.empty() and self._created < self.size:
+            self._created += 1
+            return WorkerProcess()
+        return await self._idle.get()
+
+    async def run(self, job, progress_callback=None, timeout=DOWNLOAD_TIMEOUT):
+        worker = await self._acquire()
+        try:
+            return await worker.run(job, progress_callback, timeout)
         except Exception as e:
-            print(f"Error downloading: {e}")
+            logging.error(f"Download worker error: {e}")
+            await worker.stop()
             return None
+        finally:
+            # A killed worker is restarted on its next job
+            self._idle.put_nowait(worker)
+
+    def close(self):
+        while self._idle is not None and not self._idle.empty():
+            self._idle.get_nowait().kill()
 
-def download_spotify_sync(url):
+
+process_pool = ProcessPool()
+
+async def download_spotify(url, progress_callback=None, output_dir=None, limit=None):
+    """Download a Spotify track, album, playlist or artist with one spotDL process.
+
+    Every call writes into its own directory (inside output_dir), so
+    concurrent jobs never pick up each other's files. progress_callback
+    is an optional coroutine function receiving (downloaded_tracks,
+    total_tracks or None). spotDL has no limit of its own: with `limit`
+    it downloads one track at a time and is stopped after that many, so
+    an artist link does not fetch the whole discography. Returns the
+    downloaded audio files in download order.
+    """
+    logging.info(f"Downloading Spotify URL: {url}")
+    job_dir = tempfile.mkdtemp(prefix="spotify-", dir=output_dir or DOWNLOAD_DIR)
+    template = os.path.join(job_dir, "{artist} - {title}.{output-ext}")
+    cmd = [sys.executable, "-m", "spotdl", "download", url, "--output", template]
+    if limit:
+        cmd += ["--threads", "1"]
+
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT
+    )
+    total = None
+    done = 0
     try:
-        print(f"Downloading Spotify URL: {url}")
-        
-        # Get list of files before download to identify the new one
-        before_files = set(os.listdir(DOWNLOAD_DIR))
-        
-        # Run spotdl
-        # --output format to ensure we can find it easily? Default is "{artist} - {title}.{ext}"
-        # Let's just download to DOWNLOAD_DIR
-        cmd = [sys.executable, "-m", "spotdl", url, "--output", DOWNLOAD_DIR]
-        
-        # Run with a timeout of 5 minutes
-        process = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-        
+        while True:
+            # Timeout counts from the last output, so long albums are not cut off
+            line = await asyncio.wait_for(process.stdout.readline(), SPOTIFY_TIMEOUT)
+            if not line:
+                break
+            text = line.decode(errors="replace").strip()
+            match = SPOTDL_FOUND_RE.search(text)
+            if match:
+                total = int(match.group(1))
+            elif text.startswith(("Downloaded", "Skipping")):
+                done += 1
+            else:
+                continue
+            if progress_callback:
+                await progress_callback(done, total)
+            if limit and done >= limit:
+                logging.info(f"SpotDL reached the limit of {limit} tracks, stopping it.")
+                process.kill()
+                break
+        await process.wait()
         if process.returncode != 0:
-            print(f"SpotDL error: {process.stderr}")
             # Sometimes spotdl errors but still downloads (e.g. minor metadata issues)
-            # So we proceed to check for new files
-        
-        # Check for new files
-        after_files = set(os.listdir(DOWNLOAD_DIR))
-        new_files = after_files - before_files
-        
-        # Filter for audio files
-        audio_files = [f for f in new_files if f.endswith(('.mp3', '.m4a', '.flac'))]
-        
-        if not audio_files:
-            print("No new files found after SpotDL run.")
-            return None
-            
-        # Return the first new file found (absolute path)
-        return os.path.join(DOWNLOAD_DIR, audio_files[0])
+            logging.warning(f"SpotDL exited with code {process.returncode}")
+    except asyncio.TimeoutError:
+        logging.error("SpotDL timed out")
+        process.kill()
+        await process.wait()
 
-    except subprocess.TimeoutExpired:
-        print("SpotDL timed out")
-        return None
-    except Exception as e:
-        print(f"Error downloading spotify: {e}")
-        return None
+    audio_files = sorted((os.path.join(job_dir, f) for f in os.listdir(job_dir) if f.endswith(AUDIO_EXTENSIONS)),
+                         key=os.path.getmtime)
+    if limit:
+        # A stopped run may leave the next track half written
+        for extra in audio_files[limit:]:
+            os.remove(extra)
+        audio_files = audio_files[:limit]
+    if not audio_files:
+        logging.warning("No files found after SpotDL run.")
+        remove_download(job_dir)
+    return audio_files
 
-async def download_spotify(url):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, download_spotify_sync, url)
+def remove_download(path):
+    """Delete a downloaded file (or job directory) and its job directory once empty."""
+    try:
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+            os.rmdir(path)
+            return
+        if os.path.exists(path):
+            os.remove(path)
+        parent = os.path.dirname(path)
+        if os.path.abspath(parent) != os.path.abspath(DOWNLOAD_DIR) and not os.listdir(parent):
+            os.rmdir(parent)
+    except OSError as e:
+        logging.error(f"Error removing {path}: {e}")
 
-async def download_video(url, format_str=None, progress_callback=None):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, download_video_sync, url, format_str, None, progress_callback)
+def get_job_dir(job_id, volume=DOWNLOAD_DIR):
+    """Download directory of a queued job; stable across retries and restarts."""
+    return os.path.join(volume, f"job-{job_id}")
+
+def has_partial_download(work_dir):
+    """True if a directory holds unfinished yt-dlp/segmented downloads."""
+    return bool(work_dir) and any(
+        name.endswith(('.part', '.ytdl', '.ranges')) or '.part-Frag' in name
+        for name in (os.listdir(work_dir) if os.path.isdir(work_dir) else [])
+    )
+
+async def download_video(url, format_str=None, progress_callback=None, work_dir=None, trace_id=None):
+    # Let a running prefetch finish instead of extracting twice
+    task = _info_tasks.get(normalize_url(url))
+    if task is not None:
+        try:
+            await asyncio.shield(task)
+        except Exception:
+            pass
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        if DOWNLOAD_WORKER_MODE == "process":
+            info = await asyncio.to_thread(info_cache.get, normalize_url(url))
+            job = {'url': url, 'format_str': format_str, 'info': info,
+                   'work_dir': work_dir, 'trace_id': trace_id}
+            path = await process_pool.run(job, progress_callback, DOWNLOAD_TIMEOUT)
+        else:
+            loop = asyncio.get_event_loop()
+            path = await loop.run_in_executor(
+                executor, download_video_sync, url, format_str, None, progress_callback, None, work_dir, trace_id
+            )
+        # Only a download that got somewhere is worth resuming
+        if path or attempt == DOWNLOAD_ATTEMPTS - 1 or not has_partial_download(work_dir):
+            return path
+        delay = backoff_delay(attempt, base=2)
+        logging.info(f"Download of {url} interrupted, resuming in {delay:.1f}s ({attempt + 1}/{DOWNLOAD_ATTEMPTS - 1})")
+        await asyncio.sleep(delay)
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from typing import Dict, Hashable, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+
+
+class Flight:
+    """One running download shared by everybody who asked for the same media."""
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        # Status messages of attached requesters (they receive progress edits)
+        self.messages: List = []
+        self._result = asyncio.get_running_loop().create_future()
+
+    def attach(self, message):
+        self.messages.append(message)
+
+    async def edit_text(self, text: str, raise_retry_after: bool = False):
+        """Show the same progress text to every attached requester.
+
+        Errors are ignored; with raise_retry_after, Telegram flood control
+        (TelegramRetryAfter) is re-raised after trying every message.
+        """
+        retry_after = None
+        for message in list(self.messages):
+            try:
+                await message.edit_text(text)
+            except TelegramRetryAfter as e:
+                retry_after = e
+            except Exception:
+                pass
+        if retry_after is not None and raise_retry_after:
+            raise retry_after
+
+    def resolve(self, file_id: Optional[str], media_type: Optional[str]):
+        if not self._result.done():
+            self._result.set_result((file_id, media_type) if file_id else None)
+
+    async def wait(self) -> Optional[Tuple[str, str]]:
+        """Wait for the leader. Returns (file_id, media_type) or None on failure."""
+        return await asyncio.shield(self._result)
+
+
+class InFlightRegistry:
+    """Single-flight registry: at most one download per key at a time."""
+
+    def __init__(self):
+        self._flights: Dict[Hashable, Flight] = {}
+
+    def get(self, key: Hashable) -> Optional[Flight]:
+        return self._flights.get(key)
+
+    def start(self, key: Hashable) -> Flight:
+        flight = Flight(key)
+        self._flights[key] = flight
+        return flight
+
+    def finish(self, flight: Flight):
+        # Followers of a failed leader get None
+        flight.resolve(None, None)
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        # messages includes the leader's own request
+        if len(flight.messages) > 1:
+            logging.info(f"Flight {flight.key} served {len(flight.messages) - 1} extra requester(s)")
+
+    def __len__(self):
+        return len(self._flights)
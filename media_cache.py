@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+from downloader import DOWNLOAD_DIR
+from database import (
+    get_media_entry, find_media_entries, save_media_entry, delete_media_entry,
+    get_media_cache_size, get_media_eviction_order,
+)
+
+# Where cached downloads live (skipped by the downloads cleanup)
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", os.path.join(DOWNLOAD_DIR, "cache"))
+# Disk budget of the cache in bytes (0 disables it)
+MEDIA_CACHE_BYTES = int(os.environ.get("MEDIA_CACHE_BYTES", 2 * 1024 ** 3))
+# Entries used this recently are never evicted (they may still be uploading)
+MEDIA_CACHE_PROTECT = 300
+
+
+def media_key(video_key: str, format_id: str) -> str:
+    """Cache key of one rendition: normalized video key plus yt-dlp format id."""
+    return f"{video_key}:{format_id}"
+
+
+class MediaCache:
+    """Downloaded files kept on disk for reuse, within a byte budget.
+
+    Files are stored under a hash of their key (video key + format id),
+    so the same rendition requested again, at another quality or by
+    someone else, is not downloaded twice. The index lives in SQLite;
+    the least recently (then least often) used files are evicted first.
+    """
+
+    def __init__(self, directory: str = MEDIA_CACHE_DIR, budget: int = MEDIA_CACHE_BYTES):
+        self.directory = directory
+        self.budget = budget
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    def contains_path(self, path: str) -> bool:
+        return bool(path) and os.path.abspath(os.path.dirname(path)) == os.path.abspath(self.directory)
+
+    def lookup(self, key: str):
+        """Path of a cached file, or None."""
+        if not self.enabled:
+            return None
+        path = get_media_entry(key)
+        if path and os.path.exists(path):
+            return path
+        if path:
+            # Deleted behind our back
+            delete_media_entry(key)
+        return None
+
+    def find(self, video_key: str):
+        """[(key, path)] of every cached rendition of a video, most recently used first."""
+        if not self.enabled:
+            return []
+        return [(key, path) for key, path in find_media_entries(f"{video_key}:") if os.path.exists(path)]
+
+    def store(self, key: str, path: str) -> str:
+        """Move a downloaded file into the cache. Returns its new path.
+
+        The file is left where it is if the cache is disabled or the file
+        alone exceeds the budget. Raises OSError if the move fails.
+        """
+        if not self.enabled or not os.path.exists(path):
+            return path
+        size = os.path.getsize(path)
+        if size > self.budget:
+            return path
+
+        os.makedirs(self.directory, exist_ok=True)
+        ext = os.path.splitext(path)[1]
+        cached_path = os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()[:32] + ext)
+        with self._lock:
+            self._evict(size)
+            # The job directory may be on another volume (e.g. a tmpfs): copy under a
+            # temporary name, so a half-copied file is never visible as cached
+            partial_path = cached_path + ".part"
+            try:
+                shutil.move(path, partial_path)
+                os.replace(partial_path, cached_path)
+            except OSError:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                raise
+            save_media_entry(key, cached_path, size)
+        logging.info(f"Cached {key} ({size / 1024 / 1024:.1f} MB)")
+        return cached_path
+
+    def _evict(self, incoming: int):
+        total = get_media_cache_size()
+        if total + incoming <= self.budget:
+            return
+        for key, path, size in get_media_eviction_order(time.time() - MEDIA_CACHE_PROTECT):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError as e:
+                logging.error(f"Error evicting {path}: {e}")
+                continue
+            delete_media_entry(key)
+            total -= size
+            logging.info(f"Evicted {key} from media cache")
+            if total + incoming <= self.budget:
+                return
+
+
+media_cache = MediaCache()
@@ -0,0 +1,207 @@
+import hmac
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Port of the standalone /metrics endpoint (0 disables it)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+# Keep it local by default: the endpoint has no authentication
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+# Bearer token for /metrics on the public listeners (webhook server, Vercel app); unset hides it there
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+PREFIX = "anydownload_"
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+SPEED_BUCKETS = tuple(mb * 1024 * 1024 for mb in (0.25, 0.5, 1, 2, 5, 10, 20, 50, 100))
+
+REGISTRY = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key) -> list:
+        return list(zip(self.labelnames, key))
+
+    def samples(self):
+        """Yield (name, [(label, value)], value) for the exposition."""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing value, per label set."""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, self._labels(key), value
+
+
+class Gauge(_Metric):
+    """Value that goes up and down. With `function`, it is read when scraped."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                yield self.name, [], self.function()
+            except Exception as e:
+                logging.warning(f"Gauge {self.name} failed: {e}")
+            return
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, self._labels(key), value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets, per label set."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+                    break
+            entry["sum"] += value
+            entry["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with-block in seconds."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(e["counts"]), e["sum"], e["count"]) for key, e in self._values.items()]
+        for key, counts, total, count in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", labels + [("le", _format_value(float(bound)))], cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metrics_authorized(authorization: str) -> bool:
+    """Whether an Authorization header may read /metrics on a public listener."""
+    return bool(METRICS_TOKEN) and hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}")
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST):
+    """Serve /metrics over HTTP (for polling mode). Returns the aiohttp runner."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
+
+
+STARTUP_SECONDS = Gauge("startup_seconds", "Cold start time: importing the bot, and until updates are handled.",
+                        ("phase",))
+
+# Metrics of the download pipeline, one per stage
+REQUESTS = Counter("requests_total", "Processed download requests.", ("platform", "status", "upload_path"))
+QUEUE_WAIT = Histogram("queue_wait_seconds", "Time jobs spent queued before a worker took them.")
+EXTRACT_SECONDS = Histogram("extract_seconds", "Metadata extraction time (cache misses).", ("platform",))
+INFO_CACHE = Counter("info_cache_total", "Metadata cache lookups.", ("result",))
+MEDIA_CACHE = Counter("media_cache_total", "Downloaded media cache lookups.", ("result",))
+DOWNLOAD_SECONDS = Histogram("download_seconds", "Download time.", ("platform",))
+DOWNLOAD_BYTES = Counter("download_bytes_total", "Downloaded bytes.", ("platform",))
+DOWNLOAD_SPEED = Histogram("download_speed_bytes_per_second", "Download throughput per file.",
+                           ("platform",), buckets=SPEED_BUCKETS)
+POSTPROCESS_SECONDS = Histogram("postprocess_seconds", "ffmpeg post-processing time.", ("action",))
+UPLOAD_SECONDS = Histogram("upload_seconds", "Upload time to Telegram.", ("path",))
+UPLOAD_BYTES = Counter("upload_bytes_total", "Bytes uploaded to Telegram.", ("path",))
+UPLOAD_SPEED = Histogram("upload_speed_bytes_per_second", "Upload throughput per file.",
+                         ("path",), buckets=SPEED_BUCKETS)
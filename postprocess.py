@@ -0,0 +1,266 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import struct
+import time
+
+from metrics import Gauge, POSTPROCESS_SECONDS
+
+# ffmpeg jobs running at the same time (they are CPU bound)
+FFMPEG_WORKERS = int(os.environ.get("FFMPEG_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+# Re-encode videos Telegram cannot stream (anything but H.264/AAC). CPU heavy.
+POSTPROCESS_TRANSCODE = os.environ.get("POSTPROCESS_TRANSCODE", "0") == "1"
+
+HAS_FFMPEG = shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+
+STREAMABLE_VIDEO_CODECS = ("h264",)
+STREAMABLE_AUDIO_CODECS = ("aac", "mp3")
+MP4_EXTENSIONS = (".mp4", ".m4v", ".mov")
+
+
+class PrioritySemaphore:
+    """Semaphore whose waiters are served by priority (lower first), then FIFO."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters = []
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: int = 1):
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot was handed over right before cancellation: pass it on
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def slot(self, priority: int = 1):
+        return _Slot(self, priority)
+
+
+class _Slot:
+    def __init__(self, semaphore: PrioritySemaphore, priority: int):
+        self.semaphore = semaphore
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.semaphore.acquire(self.priority)
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+
+
+ffmpeg_slots = PrioritySemaphore(FFMPEG_WORKERS)
+
+Gauge("ffmpeg_slots_busy", "ffmpeg jobs running.", function=lambda: FFMPEG_WORKERS - ffmpeg_slots._value)
+Gauge("ffmpeg_slots_waiting", "ffmpeg jobs waiting for a slot.", function=lambda: ffmpeg_slots.waiting)
+
+
+def needs_faststart(path: str) -> bool:
+    """True if an MP4's moov atom comes after the media data.
+
+    Telegram (and browsers) can only start playback before the download
+    finishes when moov is at the front. Only top-level box headers are read.
+    """
+    try:
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, box_type = struct.unpack(">I4s", header)
+                if box_type == b"moov":
+                    return False
+                if box_type == b"mdat":
+                    return True
+                if size == 1:
+                    size = struct.unpack(">Q", f.read(8))[0]
+                    f.seek(size - 16, os.SEEK_CUR)
+                elif size == 0:
+                    return False
+                else:
+                    f.seek(size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+
+async def probe(path: str) -> dict:
+    """Return {'video': codec, 'audio': codec, 'duration': seconds} (None if absent)."""
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", "-show_entries", "stream=codec_type,codec_name:format=duration",
+        "-of", "json", path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    stdout, _ = await process.communicate()
+    codecs = {"video": None, "audio": None, "duration": None}
+    try:
+        data = json.loads(stdout or b"{}")
+        for stream in data.get("streams", []):
+            kind = stream.get("codec_type")
+            if kind in ("video", "audio") and codecs[kind] is None:
+                codecs[kind] = stream.get("codec_name")
+        duration = data.get("format", {}).get("duration")
+        codecs["duration"] = float(duration) if duration else None
+    except ValueError:
+        pass
+    return codecs
+
+
+async def run_ffmpeg(args, priority: int = 1) -> bool:
+    async with ffmpeg_slots.slot(priority):
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", "-loglevel", "error", *args,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+    if process.returncode != 0:
+        logging.error(f"ffmpeg failed: {stderr.decode(errors='replace').strip()}")
+    return process.returncode == 0
+
+
+async def make_streamable(path: str, priority: int = 1):
+    """Make a downloaded video streamable in Telegram, doing as little work as possible.
+
+    H.264/AAC MP4s only get their moov atom moved to the front (a remux,
+    no re-encoding), and only if it is not there already. Other codecs are
+    re-encoded only when POSTPROCESS_TRANSCODE is on. Returns (path, stats)
+    where stats has 'action' ('none', 'remux', 'transcode') and 'seconds'.
+    """
+    started = time.time()
+    stats = {"action": "none", "seconds": 0.0}
+    if not HAS_FFMPEG or not path.lower().endswith(MP4_EXTENSIONS + (".mkv", ".webm")):
+        return path, stats
+
+    codecs = await probe(path)
+    streamable = (
+        codecs["video"] in STREAMABLE_VIDEO_CODECS
+        and codecs["audio"] in STREAMABLE_AUDIO_CODECS + (None,)
+    )
+
+    if streamable or not POSTPROCESS_TRANSCODE:
+        if path.lower().endswith(MP4_EXTENSIONS) and not needs_faststart(path):
+            stats["seconds"] = time.time() - started
+            return path, stats
+        stats["action"] = "remux"
+        codec_args = ["-c", "copy"]
+    else:
+        stats["action"] = "transcode"
+        codec_args = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"]
+        codec_args += ["-c:a", "copy"] if codecs["audio"] in STREAMABLE_AUDIO_CODECS else ["-c:a", "aac", "-b:a", "160k"]
+
+    output = os.path.splitext(path)[0] + ".tg.mp4"
+    ok = await run_ffmpeg(["-i", path, "-map", "0", *codec_args, "-movflags", "+faststart", output], priority)
+    stats["seconds"] = time.time() - started
+    if not ok:
+        if os.path.exists(output):
+            os.remove(output)
+        stats["action"] = "none"
+        return path, stats
+
+    os.remove(path)
+    final_path = os.path.splitext(path)[0] + ".mp4"
+    os.replace(output, final_path)
+    POSTPROCESS_SECONDS.observe(stats["seconds"], action=stats["action"])
+    logging.info(f"Post-processing ({stats['action']}) of {final_path} took {stats['seconds']:.1f}s")
+    return final_path, stats
+
+
+async def compress_to_size(path: str, max_bytes: int, priority: int = 1, output_dir: str = None):
+    """Re-encode a video so it fits in max_bytes. Returns (path, stats) like make_streamable.
+
+    The video bitrate is derived from the duration, keeping ~5% headroom
+    for the container. The original file is kept if encoding fails, or
+    always when output_dir is given (e.g. the source is a cached file).
+    """
+    started = time.time()
+    stats = {"action": "none", "seconds": 0.0}
+    if not HAS_FFMPEG or os.path.getsize(path) <= max_bytes:
+        return path, stats
+
+    info = await probe(path)
+    if not info["duration"]:
+        return path, stats
+    audio_bitrate = 96_000
+    video_bitrate = int(max_bytes * 8 * 0.95 / info["duration"]) - audio_bitrate
+    if video_bitrate < 100_000:
+        logging.warning(f"{path} is too long to fit in {max_bytes} bytes")
+        return path, stats
+
+    stats["action"] = "compress"
+    output = os.path.splitext(path)[0] + ".small.mp4"
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        output = os.path.join(output_dir, os.path.basename(output))
+    ok = await run_ffmpeg([
+        "-i", path, "-c:v", "libx264", "-preset", "veryfast",
+        "-b:v", str(video_bitrate), "-maxrate", str(video_bitrate), "-bufsize", str(video_bitrate * 2),
+        "-c:a", "aac", "-b:a", str(audio_bitrate), "-movflags", "+faststart", output
+    ], priority)
+    stats["seconds"] = time.time() - started
+    if not ok:
+        if os.path.exists(output):
+            os.remove(output)
+        stats["action"] = "none"
+        return path, stats
+
+    POSTPROCESS_SECONDS.observe(stats["seconds"], action=stats["action"])
+    if output_dir:
+        logging.info(f"Compressed {output} to {os.path.getsize(output)} bytes in {stats['seconds']:.1f}s")
+        return output, stats
+    os.remove(path)
+    final_path = os.path.splitext(path)[0] + ".mp4"
+    os.replace(output, final_path)
+    logging.info(f"Compressed {final_path} to {os.path.getsize(final_path)} bytes in {stats['seconds']:.1f}s")
+    return final_path, stats
+
+
+async def extract_audio(path: str, output_dir: str, priority: int = 0):
+    """Take the audio track out of a downloaded video. Returns the new file or None.
+
+    AAC/MP3 tracks are copied as is; anything else is encoded to AAC.
+    The source file is not modified.
+    """
+    if not HAS_FFMPEG:
+        return None
+    codecs = await probe(path)
+    if not codecs["audio"]:
+        return None
+    base = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0])
+    if codecs["audio"] == "mp3":
+        output, codec_args = base + ".mp3", ["-c:a", "copy"]
+    elif codecs["audio"] == "aac":
+        output, codec_args = base + ".m4a", ["-c:a", "copy"]
+    else:
+        output, codec_args = base + ".m4a", ["-c:a", "aac", "-b:a", "160k"]
+    os.makedirs(output_dir, exist_ok=True)
+    with POSTPROCESS_SECONDS.time(action="extract_audio"):
+        ok = await run_ffmpeg(["-i", path, "-vn", *codec_args, output], priority)
+    if ok:
+        return output
+    if os.path.exists(output):
+        os.remove(output)
+    return None
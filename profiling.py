@@ -0,0 +1,130 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+# Opt-in: cProfile slows Python code down noticeably while it runs
+PROFILING = os.environ.get("PROFILING", "0") == "1"
+# Fraction of jobs profiled at all
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0.2))
+# A profile is kept if its stage took at least this long...
+PROFILE_SLOW_SECONDS = float(os.environ.get("PROFILE_SLOW_SECONDS", 60))
+# ...or was among the slowest PROFILE_SLOW_PERCENT of recent runs of that stage
+PROFILE_SLOW_PERCENT = float(os.environ.get("PROFILE_SLOW_PERCENT", 5))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Oldest profiles are deleted beyond this count
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 200))
+
+# Recent durations per stage, for the percentile threshold
+WINDOW_SIZE = 200
+MIN_WINDOW = 20
+
+_durations = {}
+_lock = threading.Lock()
+# Held while a profiler runs: since Python 3.12 only one may be active per process
+_profiler_lock = threading.Lock()
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def _is_slow(stage: str, duration: float) -> bool:
+    with _lock:
+        window = _durations.setdefault(stage, deque(maxlen=WINDOW_SIZE))
+        history = sorted(window)
+        window.append(duration)
+    if duration >= PROFILE_SLOW_SECONDS:
+        return True
+    if len(history) < MIN_WINDOW:
+        return False
+    threshold = history[int(len(history) * (1 - PROFILE_SLOW_PERCENT / 100))]
+    return duration >= threshold
+
+
+def _save(profiler: cProfile.Profile, trace_id: str, stage: str, duration: float):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, f"{trace_id}-{stage}")
+    profiler.dump_stats(base + ".prof")
+
+    summary = io.StringIO()
+    summary.write(f"trace={trace_id} stage={stage} seconds={duration:.2f} at={time.strftime('%Y-%m-%d %H:%M:%S')}\n\n")
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(40)
+    with open(base + ".txt", "w", encoding="utf-8") as f:
+        f.write(summary.getvalue())
+    logging.info(f"Saved profile of slow {stage} ({duration:.1f}s), trace {trace_id}")
+
+    files = sorted(
+        (os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR)),
+        key=os.path.getmtime
+    )
+    for path in files[:-PROFILE_KEEP * 2]:
+        os.remove(path)
+
+
+@contextmanager
+def profile_stage(stage: str, trace_id: str = None):
+    """Profile a block with cProfile and keep the result if it was slow.
+
+    Does nothing unless PROFILING is on, the job is sampled and no other
+    profiler is running (in any thread). In a coroutine the profile covers
+    everything the event loop ran meanwhile, not just this job.
+    """
+    if (not PROFILING or not trace_id or random.random() >= PROFILE_SAMPLE_RATE
+            or not _profiler_lock.acquire(blocking=False)):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiling tool (not ours) is active
+        _profiler_lock.release()
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profiler_lock.release()
+        duration = time.perf_counter() - started
+        if _is_slow(stage, duration):
+            try:
+                _save(profiler, trace_id, stage, duration)
+            except OSError as e:
+                logging.error(f"Failed to save profile {trace_id}-{stage}: {e}")
+
+
+def list_profiles(limit: int = 20):
+    """[(trace_id, stage, header line)] of saved profiles, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    summaries = sorted(
+        (os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR) if name.endswith(".txt")),
+        key=os.path.getmtime, reverse=True
+    )[:limit]
+    profiles = []
+    for path in summaries:
+        trace_id, _, stage = os.path.basename(path)[:-4].partition("-")
+        with open(path, encoding="utf-8") as f:
+            profiles.append((trace_id, stage, f.readline().strip()))
+    return profiles
+
+
+def get_profile_files(trace_id: str):
+    """Paths of every file saved for a trace (.txt summaries and .prof dumps)."""
+    if not os.path.isdir(PROFILE_DIR) or not trace_id.isalnum():
+        return []
+    return sorted(
+        os.path.join(PROFILE_DIR, name) for name in os.listdir(PROFILE_DIR)
+        if name.startswith(f"{trace_id}-")
+    )
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from inflight import Flight
+
+# Minimum seconds between edits of one status message
+PROGRESS_MIN_INTERVAL = float(os.environ.get("PROGRESS_MIN_INTERVAL", 3))
+# Edits per second for all status messages together
+PROGRESS_GLOBAL_RATE = float(os.environ.get("PROGRESS_GLOBAL_RATE", 10))
+# Interval never grows beyond this, however many jobs run or 429s arrive
+MAX_INTERVAL = 30
+
+STAGE_LABELS = {
+    "download": "📥 **Скачиваю:**",
+    "upload": "📤 **Загрузка в Telegram:**",
+    "stream": "📥📤 **Скачиваю и загружаю:**",
+    "tracks": "🎧 **Скачано треков:**",
+    "items": "📚 **Скачано:**",
+}
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def format_progress(stage: str, current: float, total: float = None, speed: float = None) -> str:
+    """Progress text for a stage; byte stages get a percentage, speed and ETA."""
+    label = STAGE_LABELS.get(stage, "⏳")
+    if stage in ("tracks", "items"):
+        return f"{label} {int(current)}/{int(total) if total else '?'}"
+    if total:
+        text = f"{label} {current * 100 / total:.1f}%"
+    else:
+        text = f"{label} {current / 1024 / 1024:.1f} MB"
+    if speed:
+        text += f"\n🚀 **Скорость:** {speed / 1024 / 1024:.1f} MB/s"
+        if total and total > current:
+            text += f"\n⏳ **Осталось:** {_format_duration((total - current) / speed)}"
+    return text
+
+
+class _Entry:
+    __slots__ = ("target", "stage", "current", "total", "speed", "dirty", "last_edit", "last_text",
+                 "sample_time", "sample_bytes")
+
+    def __init__(self, target):
+        self.target = target
+        self.stage = None
+        self.current = 0
+        self.total = None
+        self.speed = None
+        self.dirty = False
+        self.last_edit = 0.0
+        self.last_text = None
+        self.sample_time = None
+        self.sample_bytes = 0
+
+
+class ProgressDispatcher:
+    """Turns raw progress counters from any thread into rate-limited Telegram edits.
+
+    report() only stores the latest counters of a status message (later
+    reports replace earlier ones), so it is cheap enough to call from
+    every yt-dlp hook tick. One task on the event loop formats and sends
+    the edits: each message at most every `interval` seconds, where the
+    interval grows with the number of active messages (to stay within
+    PROGRESS_GLOBAL_RATE) and doubles after a 429 from Telegram.
+    """
+
+    def __init__(self, min_interval: float = PROGRESS_MIN_INTERVAL, global_rate: float = PROGRESS_GLOBAL_RATE):
+        self.min_interval = min_interval
+        self.global_rate = global_rate
+        self._entries = {}  # id(target) -> _Entry
+        self._lock = threading.Lock()
+        self._penalty = 1.0  # multiplier raised by 429s, decays on success
+        self._paused_until = 0.0
+        self._task = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def report(self, target, stage: str, current: float, total: float = None, speed: float = None):
+        """Record progress for a status message. Safe to call from any thread."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(id(target))
+            if entry is None:
+                entry = self._entries[id(target)] = _Entry(target)
+            if entry.stage != stage:
+                entry.stage, entry.sample_time, entry.sample_bytes = stage, None, 0
+            if speed is None and stage not in ("tracks", "items"):
+                # Derive the speed from consecutive samples
+                if entry.sample_time is not None and now - entry.sample_time >= 1:
+                    entry.speed = (current - entry.sample_bytes) / (now - entry.sample_time)
+                    entry.sample_time, entry.sample_bytes = now, current
+                elif entry.sample_time is None:
+                    entry.sample_time, entry.sample_bytes = now, current
+                speed = entry.speed
+            entry.current, entry.total, entry.speed, entry.dirty = current, total, speed, True
+
+    def clear(self, target):
+        """Drop pending progress of a message (before a final status is shown)."""
+        with self._lock:
+            self._entries.pop(id(target), None)
+
+    def hook(self, target, stage: str = "download"):
+        """yt-dlp progress hook reporting to a status message."""
+        def hook(d):
+            if d.get('status') != 'downloading':
+                return
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            self.report(target, stage, d.get('downloaded_bytes') or 0, total, d.get('speed'))
+        return hook
+
+    def callback(self, target, stage: str):
+        """Async (current, total) callback, as used by the uploader and spotDL."""
+        async def callback(current, total):
+            self.report(target, stage, current, total or None)
+        return callback
+
+    @property
+    def interval(self) -> float:
+        with self._lock:
+            active = len(self._entries)
+        interval = max(self.min_interval, active / self.global_rate) * self._penalty
+        return min(interval, MAX_INTERVAL)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(min(1.0, self.min_interval / 2))
+            now = time.monotonic()
+            if now < self._paused_until:
+                continue
+            interval = self.interval
+            with self._lock:
+                due = [e for e in self._entries.values() if e.dirty and now - e.last_edit >= interval]
+            for entry in due:
+                with self._lock:
+                    text = format_progress(entry.stage, entry.current, entry.total, entry.speed)
+                    entry.dirty = False
+                if text == entry.last_text:
+                    continue
+                entry.last_edit = time.monotonic()
+                if not await self._edit(entry, text):
+                    break
+
+    async def _edit(self, entry, text: str) -> bool:
+        """Send one edit. Returns False if Telegram asked to slow down."""
+        try:
+            if isinstance(entry.target, Flight):
+                await entry.target.edit_text(text, raise_retry_after=True)
+            else:
+                await entry.target.edit_text(text)
+        except TelegramRetryAfter as e:
+            self._paused_until = time.monotonic() + e.retry_after
+            self._penalty = min(self._penalty * 2, MAX_INTERVAL / self.min_interval)
+            entry.dirty = True
+            logging.warning(f"Progress edits paused for {e.retry_after}s (flood control)")
+            return False
+        except TelegramBadRequest:
+            # "message is not modified" or the message is gone
+            pass
+        except Exception as e:
+            logging.debug(f"Progress edit failed: {e}")
+        entry.last_text = text
+        self._penalty = max(1.0, self._penalty * 0.9)
+        return True
+
+
+progress_dispatcher = ProgressDispatcher()
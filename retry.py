@@ -0,0 +1,11 @@
+import random
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    """Seconds to wait before retrying after failed attempt number `attempt` (0-based).
+
+    Exponential backoff with jitter: half of the delay is fixed, the other
+    half random, so clients failing together do not retry in lockstep.
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
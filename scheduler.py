@@ -0,0 +1,135 @@
+import asyncio
+import calendar
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from coordination import WORKER_ID, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT
+from database import (
+    enqueue_job, claim_next_job, finish_job, get_queue_position, requeue_interrupted_jobs,
+    touch_worker, release_worker_flights, get_pending_job_ids, run_db,
+)
+from metrics import QUEUE_WAIT
+
+# Number of downloads running at the same time
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 5))
+# A single user never holds more than this many download slots
+MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", 2))
+
+
+def get_job_priority(quality: str) -> int:
+    """Lower runs first: audio, then small video, then large video."""
+    if quality in ("audio", "spotify"):
+        return 0
+    if quality.isdigit():
+        return 1 if int(quality) <= 480 else 2 if int(quality) <= 720 else 3
+    return 1
+
+
+class JobScheduler:
+    """Persistent download queue backed by the jobs table.
+
+    Jobs survive restarts: the ones that were running when the bot
+    stopped are queued again on start(). Several nodes may share the
+    table; each sends heartbeats for its running jobs, and jobs of a node
+    that went silent are queued again for the others. Workers pick jobs
+    fairly across users (see database.claim_next_job).
+    """
+
+    def __init__(self, runner: Callable[[dict, Optional[object]], Awaitable[None]],
+                 workers: int = DOWNLOAD_WORKERS, max_per_user: int = MAX_JOBS_PER_USER):
+        # runner(job, message) does the actual work; message is None for recovered
+        # jobs and jobs queued on another node
+        self.runner = runner
+        self.workers = workers
+        self.max_per_user = max_per_user
+        self.running = 0
+        self._messages: Dict[int, object] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    async def start(self):
+        requeued = await run_db(requeue_interrupted_jobs, HEARTBEAT_TIMEOUT, WORKER_ID)
+        if requeued:
+            logging.info(f"Resuming {requeued} job(s) interrupted by restart")
+        await run_db(release_worker_flights, WORKER_ID)
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def submit(self, user_id: int, chat_id: int, url: str, quality: str, message=None) -> Tuple[Optional[int], int]:
+        """Queue a job. Returns (job_id, number of jobs ahead of it)."""
+        job_id = await run_db(enqueue_job, user_id, chat_id, url, quality, get_job_priority(quality))
+        if job_id is None:
+            return None, 0
+        # Only a local worker ever takes the message back
+        if message is not None and self.workers > 0:
+            self._messages[job_id] = message
+        self._wakeup.set()
+        return job_id, await run_db(get_queue_position, job_id)
+
+    @property
+    def is_busy(self) -> bool:
+        # Without local workers (WORKER_ROLE=bot) the queue position tells it all
+        return self.workers > 0 and self.running >= self.workers
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await run_db(touch_worker, WORKER_ID)
+                requeued = await run_db(requeue_interrupted_jobs, HEARTBEAT_TIMEOUT)
+                if requeued:
+                    logging.warning(f"Took over {requeued} job(s) of a node that stopped responding")
+                    self._wakeup.set()
+                if self._messages:
+                    await self._prune_messages()
+            except Exception as e:
+                logging.error(f"Heartbeat error: {e}")
+
+    async def _prune_messages(self):
+        """Forget the messages of jobs another node took, or that went away."""
+        pending = await run_db(get_pending_job_ids, WORKER_ID)
+        if pending is None:
+            return
+        pending = set(pending)
+        for job_id in [job_id for job_id in self._messages if job_id not in pending]:
+            del self._messages[job_id]
+
+    async def _worker(self):
+        while True:
+            self._wakeup.clear()
+            job = await run_db(claim_next_job, self.max_per_user, WORKER_ID)
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if job["attempts"] == 0:
+                # First run only: a resumed job's wait includes the downtime
+                created = calendar.timegm(time.strptime(job["created_at"], "%Y-%m-%d %H:%M:%S"))
+                QUEUE_WAIT.observe(max(0.0, time.time() - created))
+
+            self.running += 1
+            status = "done"
+            try:
+                await self.runner(job, self._messages.pop(job["id"], None))
+            except asyncio.CancelledError:
+                # Shutting down: leave the job running so it is resumed
+                raise
+            except Exception as e:
+                status = "failed"
+                logging.error(f"Job {job['id']} failed: {e}", exc_info=True)
+            finally:
+                self.running -= 1
+            await run_db(finish_job, job["id"], status)
+            # A finished job may unblock a user at the per-user limit
+            self._wakeup.set()
@@ -0,0 +1,181 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+import yt_dlp
+from yt_dlp.downloader.common import FileDownloader
+from yt_dlp.downloader.http import HttpFD
+
+from retry import backoff_delay
+
+# Parallel connections per file (1 disables segmented downloads)
+SEGMENTED_CONNECTIONS = int(os.environ.get("SEGMENTED_CONNECTIONS", 4))
+# Bytes per range request; CDNs (googlevideo) throttle much larger ranges
+SEGMENT_SIZE = int(os.environ.get("SEGMENT_SIZE", 10 * 1024 * 1024))
+# Files smaller than this are not worth splitting
+MIN_SEGMENTED_SIZE = 2 * SEGMENT_SIZE
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+class SegmentedHttpFD(FileDownloader):
+    """Downloads an HTTP(S) file over several connections, one byte range at a time.
+
+    Ranges are fetched in parallel with aiohttp and written in place into
+    the .part file. Progress is reported through the normal yt-dlp hooks,
+    aggregated over all connections.
+    """
+
+    FD_NAME = 'segmented'
+
+    @classmethod
+    def can_download(cls, info_dict):
+        return (
+            info_dict.get('protocol') in ('http', 'https')
+            and not info_dict.get('is_live')
+            and (info_dict.get('filesize') or 0) >= MIN_SEGMENTED_SIZE
+        )
+
+    def real_download(self, filename, info_dict):
+        url = info_dict['url']
+        total = info_dict['filesize']
+        headers = dict(info_dict.get('http_headers') or {})
+        # Compressed responses would break byte offsets
+        headers['Accept-Encoding'] = 'identity'
+        cookie = self.ydl.cookiejar.get_cookie_header(url)
+        if cookie:
+            headers['Cookie'] = cookie
+
+        tmpfilename = self.temp_name(filename)
+        # Offsets of finished ranges, so an interrupted download resumes
+        ranges_file = tmpfilename + '.ranges'
+        done = set()
+        if (self.params.get('continuedl', True) and os.path.exists(ranges_file)
+                and os.path.exists(tmpfilename) and os.path.getsize(tmpfilename) == total):
+            with open(ranges_file) as f:
+                done = {int(line) for line in f if line.strip().isdigit()}
+            if done:
+                self.to_screen(f'[segmented] Resuming: {len(done)} range(s) already downloaded')
+        else:
+            with open(tmpfilename, 'wb') as f:
+                f.truncate(total)
+            open(ranges_file, 'w').close()
+
+        start = time.time()
+        try:
+            asyncio.run(self._fetch_all(url, headers, tmpfilename, total, filename, info_dict, start, done, ranges_file))
+        except RangesNotSupported:
+            # Server ignores Range: let yt-dlp's single-stream downloader do it
+            os.remove(tmpfilename)
+            os.remove(ranges_file)
+            fd = HttpFD(self.ydl, self.params)
+            for ph in self._progress_hooks:
+                if ph != self.report_progress:
+                    fd.add_progress_hook(ph)
+            return fd.real_download(filename, info_dict)
+
+        self.try_rename(tmpfilename, filename)
+        os.remove(ranges_file)
+        self._hook_progress({
+            'status': 'finished',
+            'downloaded_bytes': total,
+            'total_bytes': total,
+            'filename': filename,
+            'elapsed': time.time() - start,
+        }, info_dict)
+        return True
+
+    async def _fetch_all(self, url, headers, tmpfilename, total, filename, info_dict, start, done, ranges_file):
+        ranges = asyncio.Queue()
+        downloaded = 0
+        for offset in range(0, total, SEGMENT_SIZE):
+            last = min(offset + SEGMENT_SIZE, total) - 1
+            if offset in done:
+                downloaded += last - offset + 1
+            else:
+                ranges.put_nowait((offset, last))
+
+        last_report = 0
+
+        def report():
+            nonlocal last_report
+            now = time.time()
+            if now - last_report < 0.5 and downloaded < total:
+                return
+            last_report = now
+            elapsed = now - start
+            speed = downloaded / elapsed if elapsed else None
+            self._hook_progress({
+                'status': 'downloading',
+                'downloaded_bytes': downloaded,
+                'total_bytes': total,
+                'filename': filename,
+                'tmpfilename': tmpfilename,
+                'elapsed': elapsed,
+                'speed': speed,
+                'eta': (total - downloaded) / speed if speed else None,
+            }, info_dict)
+
+        async def fetch_range(session, fd, first, last, retries=self.params.get('retries', 3)):
+            nonlocal downloaded
+            position = first
+            for attempt in range(retries + 1):
+                try:
+                    range_headers = {**headers, 'Range': f'bytes={position}-{last}'}
+                    async with session.get(url, headers=range_headers) as response:
+                        if response.status == 200:
+                            raise RangesNotSupported()
+                        response.raise_for_status()
+                        async for chunk in response.content.iter_chunked(256 * 1024):
+                            os.pwrite(fd, chunk, position)
+                            position += len(chunk)
+                            downloaded += len(chunk)
+                            report()
+                    if position > last:
+                        with open(ranges_file, 'a') as f:
+                            f.write(f'{first}\n')
+                        return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt == retries:
+                        raise yt_dlp.utils.DownloadError(f'Segment {first}-{last} failed: {e}')
+                    self.ydl.report_warning(f'Segment {first}-{last} failed: {e}. Retrying ({attempt + 1}/{retries})...')
+                    await asyncio.sleep(backoff_delay(attempt))
+            raise yt_dlp.utils.DownloadError(f'Segment {first}-{last} incomplete')
+
+        async def worker(session, fd):
+            while not ranges.empty():
+                first, last = ranges.get_nowait()
+                await fetch_range(session, fd, first, last)
+
+        fd = os.open(tmpfilename, os.O_WRONLY)
+        try:
+            connector = aiohttp.TCPConnector(limit=SEGMENTED_CONNECTIONS)
+            timeout = aiohttp.ClientTimeout(sock_read=self.params.get('socket_timeout') or 20)
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                await asyncio.gather(*(worker(session, fd) for _ in range(SEGMENTED_CONNECTIONS)))
+        finally:
+            os.close(fd)
+
+
+class SegmentedYoutubeDL(yt_dlp.YoutubeDL):
+    """YoutubeDL that uses SegmentedHttpFD for large plain HTTP(S) formats.
+
+    DASH/HLS formats keep yt-dlp's own downloaders, which fetch fragments
+    in parallel when 'concurrent_fragment_downloads' is set.
+    """
+
+    def dl(self, name, info, subtitle=False, test=False):
+        if (test or name == '-' or SEGMENTED_CONNECTIONS < 2 or self.params.get('proxy')
+                or not SegmentedHttpFD.can_download(info)):
+            return super().dl(name, info, subtitle, test)
+
+        fd = SegmentedHttpFD(self, self.params)
+        for ph in self._progress_hooks:
+            fd.add_progress_hook(ph)
+        new_info = self._copy_infodict(info)
+        if new_info.get('http_headers') is None:
+            new_info['http_headers'] = self._calc_headers(new_info)
+        return fd.download(name, new_info, subtitle)
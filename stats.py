@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import os
+
+from database import log_downloads, run_db
+
+# Rows written per transaction, and the longest a row waits for one
+STATS_BATCH_SIZE = int(os.environ.get("STATS_BATCH_SIZE", 50))
+STATS_FLUSH_MS = int(os.environ.get("STATS_FLUSH_MS", 2000))
+
+
+class StatsWriter:
+    """Collects download_stats rows and writes them in batches in the background.
+
+    record() only appends to a queue, so the download path never waits
+    for the database. A batch is committed when STATS_BATCH_SIZE rows
+    are waiting or STATS_FLUSH_MS after its first row.
+    """
+
+    def __init__(self, batch_size: int = STATS_BATCH_SIZE, flush_ms: int = STATS_FLUSH_MS):
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self._queue = asyncio.Queue()
+        self._batch = []  # rows taken off the queue but not handed to the database yet
+        self._task = None
+
+    def record(self, **row):
+        self._queue.put_nowait(row)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer and write whatever is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        batch, self._batch = self._batch, []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if batch:
+            await run_db(log_downloads, batch)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch.append(await self._queue.get())
+            deadline = loop.time() + self.flush_ms / 1000
+            while len(self._batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    self._batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._batch = self._batch, []
+            try:
+                await run_db(log_downloads, batch)
+            except Exception as e:
+                logging.error(f"Stats writer error: {e}")
+
+
+stats_writer = StatsWriter()
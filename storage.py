@@ -0,0 +1,263 @@
+import asyncio
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional, Tuple
+
+from coordination import WORKER_ID
+from downloader import DOWNLOAD_DIR, get_job_dir
+from metrics import Gauge
+
+# Volumes for temporary files, tried in order: "path=max_job_bytes,path". A volume with a
+# limit only takes jobs estimated at most that big, e.g. a tmpfs for audio before the disk
+TEMP_VOLUMES = os.environ.get("TEMP_VOLUMES", DOWNLOAD_DIR)
+# Bytes always left free on every volume
+DISK_FREE_MIN = int(os.environ.get("DISK_FREE_MIN", 256 * 1024 * 1024))
+# Peak disk use of a job relative to its media size: .part files, merge output, faststart copy
+DISK_ESTIMATE_FACTOR = float(os.environ.get("DISK_ESTIMATE_FACTOR", 2.5))
+# Assumed media size when the extractor does not report one (audio: Spotify tracks, audio formats)
+DISK_DEFAULT_ESTIMATE = int(os.environ.get("DISK_DEFAULT_ESTIMATE", 200 * 1024 * 1024))
+DISK_AUDIO_ESTIMATE = int(os.environ.get("DISK_AUDIO_ESTIMATE", 10 * 1024 * 1024))
+
+# Free space is re-read this often while jobs wait (other processes use the disk too)
+RECHECK_SECONDS = 5
+# The sweep leaves newer entries alone
+SWEEP_MIN_AGE = 600
+
+
+class NotEnoughDiskSpace(Exception):
+    """No volume can ever take the job: it does not fit even with no other job running."""
+
+
+class Volume:
+    def __init__(self, path: str, max_job_bytes: Optional[int] = None):
+        self.path = path
+        self.max_job_bytes = max_job_bytes
+
+    def accepts(self, estimate: int) -> bool:
+        return self.max_job_bytes is None or estimate <= self.max_job_bytes
+
+
+def parse_volumes(spec: str) -> List[Volume]:
+    volumes = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        path, _, limit = item.partition("=")
+        volumes.append(Volume(path, int(limit) if limit else None))
+    return volumes or [Volume(DOWNLOAD_DIR)]
+
+
+def estimate_job_bytes(selected: Optional[dict], audio: bool = False) -> Tuple[int, bool]:
+    """Disk a download will need at its peak, from the format yt-dlp selected.
+
+    Returns (bytes, guessed); guessed is True when the size is unknown and
+    a default was assumed.
+    """
+    formats = (selected or {}).get("requested_formats") or ([selected] if selected else [])
+    sizes = [f.get("filesize") or f.get("filesize_approx") for f in formats]
+    if not sizes or not all(sizes):
+        default = DISK_AUDIO_ESTIMATE if audio else DISK_DEFAULT_ESTIMATE
+        return int(default * DISK_ESTIMATE_FACTOR), True
+    return int(sum(sizes) * DISK_ESTIMATE_FACTOR), False
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Reservation:
+    """Disk reserved for one job, and the directory all its temporary files go to."""
+
+    def __init__(self, volume: Volume, size: int, directory: str):
+        self.volume = volume
+        self.size = size
+        self.directory = directory
+
+    def remaining(self) -> int:
+        """Reserved bytes not written yet (written ones already show in the free space)."""
+        return max(0, self.size - _dir_size(self.directory))
+
+
+class DiskBudget:
+    """Admission control for temporary disk space.
+
+    A job reserves its estimated peak disk use before it starts and waits
+    while no volume can take it, so parallel jobs never fill a volume
+    together. The reservation owns a directory, deleted with all its files
+    when the job ends; the sweep only removes what no reservation or
+    queued job owns any more.
+    """
+
+    def __init__(self, volumes: List[Volume], free_min: int = DISK_FREE_MIN):
+        self.volumes = volumes
+        self.free_min = free_min
+        for volume in volumes:
+            os.makedirs(volume.path, exist_ok=True)
+        self.reservations: List[Reservation] = []
+        self.waiting = 0
+        self._changed = asyncio.Condition()
+        self._ids = itertools.count(1)
+
+    def node_dir(self, volume: Volume) -> str:
+        """This node's directory on a volume (volumes may be shared by several nodes)."""
+        return os.path.join(volume.path, WORKER_ID)
+
+    def available(self, volume: Volume) -> int:
+        try:
+            free = shutil.disk_usage(volume.path).free
+        except OSError:
+            return 0
+        reserved = sum(r.remaining() for r in self.reservations if r.volume is volume)
+        return free - self.free_min - reserved
+
+    def _pick(self, estimate: int, guessed: bool) -> Optional[Volume]:
+        candidates = [v for v in self.volumes if v.accepts(estimate)] or self.volumes[-1:]
+        for volume in candidates:
+            if self.available(volume) >= estimate:
+                return volume
+        # Waiting only helps if one of our jobs is going to free space
+        if any(r.volume in candidates for r in self.reservations):
+            return None
+        if guessed:
+            # The size is only a default: let it try alone on the last volume
+            return candidates[-1]
+        raise NotEnoughDiskSpace(f"{estimate} bytes do not fit on {', '.join(v.path for v in candidates)}")
+
+    def _volume_of(self, directory: str) -> Volume:
+        """The volume a directory is on (the innermost one holding it)."""
+        directory = os.path.abspath(directory)
+        holding = [v for v in self.volumes
+                   if os.path.commonpath([directory, os.path.abspath(v.path)]) == os.path.abspath(v.path)]
+        if not holding:
+            return self.volumes[-1]
+        return max(holding, key=lambda v: len(os.path.abspath(v.path)))
+
+    async def reserve(self, estimate: int, directory: str = None, job_id: int = None,
+                      on_wait=None, guessed: bool = False) -> Reservation:
+        """Wait until `estimate` bytes fit on a volume and reserve them.
+
+        `directory` keeps a job's existing directory (it may hold a partial
+        download) on its volume; a new one is named after job_id if given.
+        on_wait is an optional coroutine function called once if the job
+        has to wait. Raises NotEnoughDiskSpace if the space is missing and
+        no job of ours holds any that could be freed, unless the estimate
+        is `guessed` (the job then runs alone and may still fit).
+        """
+        notified = False
+        while True:
+            async with self._changed:
+                volume = self._admit(estimate, directory, guessed)
+                if volume is not None:
+                    if directory is None and job_id is not None:
+                        directory = get_job_dir(job_id, volume.path)
+                    elif directory is None:
+                        directory = os.path.join(self.node_dir(volume), f"r{next(self._ids)}")
+                    os.makedirs(directory, exist_ok=True)
+                    reservation = Reservation(volume, estimate, directory)
+                    self.reservations.append(reservation)
+                    return reservation
+            if on_wait is not None and not notified:
+                notified = True
+                await on_wait()
+            async with self._changed:
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self._changed.wait(), RECHECK_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self.waiting -= 1
+
+    def _admit(self, estimate: int, directory: str = None, guessed: bool = False) -> Optional[Volume]:
+        if directory is None:
+            return self._pick(estimate, guessed)
+        volume = self._volume_of(directory)
+        # Whatever was downloaded before already shows in the free space
+        needed = estimate - (_dir_size(directory) if os.path.isdir(directory) else 0)
+        if self.available(volume) >= needed:
+            return volume
+        if any(r.volume is volume for r in self.reservations):
+            return None
+        if guessed:
+            return volume
+        raise NotEnoughDiskSpace(f"{needed} more bytes do not fit on {volume.path}")
+
+    async def release(self, reservation: Reservation, keep: bool = False):
+        """Give the space back and delete the job's files, unless `keep` (to resume them later)."""
+        if not keep:
+            await asyncio.to_thread(shutil.rmtree, reservation.directory, True)
+        async with self._changed:
+            self.reservations.remove(reservation)
+            self._changed.notify_all()
+
+    @asynccontextmanager
+    async def reserved(self, estimate: int, directory: str = None, job_id: int = None, on_wait=None,
+                       guessed: bool = False):
+        reservation = await self.reserve(estimate, directory, job_id, on_wait, guessed)
+        keep = False
+        try:
+            yield reservation
+        except asyncio.CancelledError:
+            # Shutting down: a queued job resumes from its partial files
+            keep = True
+            raise
+        finally:
+            await self.release(reservation, keep)
+
+    def sweep(self, active_dirs, active_job_ids=()) -> int:
+        """Delete temporary files nothing owns any more. Returns the number of entries removed.
+
+        Owned are the directories of live reservations and of queued or
+        running jobs (active_dirs, from every node). The job-<id> directory
+        of an active job is kept even before the job records it, and so is
+        anything younger than SWEEP_MIN_AGE, which may belong to a job
+        queued after active_job_ids was read. Other nodes' directories
+        are left alone; plain files and spotify-* directories at a volume
+        root were left by older versions (plain files are kept in the
+        system temp directory, which other programs use too).
+        """
+        keep = {os.path.abspath(d) for d in active_dirs}
+        keep |= {os.path.abspath(r.directory) for r in self.reservations}
+        keep |= {os.path.abspath(get_job_dir(job_id, v.path)) for job_id in active_job_ids for v in self.volumes}
+        now = time.time()
+        removed = 0
+        for volume in self.volumes:
+            if not os.path.isdir(volume.path):
+                continue
+            node_dir = self.node_dir(volume)
+            shared_tmp = os.path.abspath(volume.path) == os.path.abspath(tempfile.gettempdir())
+            entries = [os.path.join(volume.path, name) for name in os.listdir(volume.path)
+                       if name.startswith(("job-", "spotify-"))
+                       or (not shared_tmp and os.path.isfile(os.path.join(volume.path, name)))]
+            if os.path.isdir(node_dir):
+                entries += [os.path.join(node_dir, name) for name in os.listdir(node_dir)]
+            for path in entries:
+                try:
+                    if os.path.abspath(path) in keep or now - os.path.getmtime(path) < SWEEP_MIN_AGE:
+                        continue
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.error(f"Error deleting {path}: {e}")
+        return removed
+
+
+disk_budget = DiskBudget(parse_volumes(TEMP_VOLUMES))
+
+Gauge("disk_reserved_bytes", "Disk reserved by running jobs.", function=lambda: sum(r.size for r in disk_budget.reservations))
+Gauge("disk_admission_waiting", "Jobs waiting for disk space.", function=lambda: disk_budget.waiting)
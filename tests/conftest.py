@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# database.py opens its file at import time: point it somewhere disposable first
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="anydownload-test-"), "bot.db"))
+os.environ.setdefault("API_TOKEN", "123:test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+
+import downloader
+
+CHANNEL = "https://www.youtube.com/@someone"
+VIDEOS_TAB = CHANNEL + "/videos"
+
+
+class FakeYDL:
+    pages = {
+        CHANNEL: {"_type": "playlist", "title": "Someone", "entries": [
+            {"_type": "url", "url": VIDEOS_TAB},
+            {"_type": "url", "url": CHANNEL + "/shorts"},
+        ]},
+        VIDEOS_TAB: {"_type": "playlist", "title": "Someone - Videos", "entries": [
+            {"_type": "url", "url": f"https://www.youtube.com/watch?v={i}"} for i in range(5)
+        ]},
+    }
+
+    def extract_info(self, url, download=False):
+        return self.pages[url]
+
+    def sanitize_info(self, info):
+        return info
+
+
+class FakePool:
+    @contextmanager
+    def lease(self, params, progress_callback=None, cls=None):
+        yield FakeYDL()
+
+
+def test_channel_is_expanded_through_its_first_tab(monkeypatch):
+    monkeypatch.setattr(downloader, "ydl_pool", FakePool())
+
+    title, urls = downloader.expand_collection_sync(CHANNEL, 3)
+
+    assert title == "Someone"
+    assert urls == [f"https://www.youtube.com/watch?v={i}" for i in range(3)]
+
+
+def test_media_groups_never_hold_a_single_item():
+    from bot import split_media_groups
+
+    assert [len(g) for g in split_media_groups(list(range(11)))] == [6, 5]
+    assert [len(g) for g in split_media_groups(list(range(20)))] == [10, 10]
+    assert [len(g) for g in split_media_groups(list(range(21)))] == [7, 7, 7]
+    assert [len(g) for g in split_media_groups([1])] == [1]
+    assert split_media_groups([]) == []
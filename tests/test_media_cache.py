@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+import pytest
+
+from media_cache import MediaCache
+
+SHM = "/dev/shm"
+
+
+@pytest.mark.skipif(not os.path.isdir(SHM), reason="needs /dev/shm")
+def test_store_across_filesystems(tmp_path):
+    job_dir = tempfile.mkdtemp(dir=SHM)
+    if os.stat(job_dir).st_dev == os.stat(tmp_path).st_dev:
+        pytest.skip("/dev/shm is on the same filesystem")
+    path = os.path.join(job_dir, "video.mp4")
+    with open(path, "wb") as f:
+        f.write(b"x" * 1024)
+
+    cache = MediaCache(str(tmp_path / "cache"), budget=10 * 1024)
+    cached_path = cache.store("youtube:abc:137", path)
+
+    assert cache.contains_path(cached_path)
+    assert os.path.getsize(cached_path) == 1024
+    assert not os.path.exists(path)
+    assert not os.path.exists(cached_path + ".part")
+    assert cache.lookup("youtube:abc:137") == cached_path
+    os.rmdir(job_dir)
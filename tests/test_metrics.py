@@ -0,0 +1,10 @@
+import metrics
+
+
+def test_public_metrics_need_the_token(monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "")
+    assert not metrics.metrics_authorized("")
+    assert not metrics.metrics_authorized("Bearer ")
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "secret")
+    assert not metrics.metrics_authorized("Bearer wrong")
+    assert metrics.metrics_authorized("Bearer secret")
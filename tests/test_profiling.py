@@ -0,0 +1,33 @@
+import threading
+
+import profiling
+
+
+def test_concurrent_stages_in_other_threads_are_skipped(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiling, "PROFILING", True)
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path))
+    errors = []
+    inside = threading.Event()
+    leave = threading.Event()
+
+    def run(stage, hold):
+        try:
+            with profiling.profile_stage(stage, "trace"):
+                if hold:
+                    inside.set()
+                    leave.wait(5)
+        except Exception as e:
+            errors.append(e)
+
+    first = threading.Thread(target=run, args=("download", True))
+    first.start()
+    inside.wait(5)
+    second = threading.Thread(target=run, args=("upload", False))
+    second.start()
+    second.join(5)
+    leave.set()
+    first.join(5)
+
+    assert errors == []
+    assert not profiling._profiler_lock.locked()
@@ -0,0 +1,15 @@
+import database
+from database import enqueue_job, claim_next_job, get_queue_position
+
+
+def test_queue_position_follows_claim_order():
+    database.init_db()
+    busy = enqueue_job(1, 1, "https://example.com/a", "best", 1)
+    assert claim_next_job(2)["id"] == busy
+    # User 1 already runs a job: user 2's later jobs are served before user 1's
+    first = enqueue_job(1, 1, "https://example.com/b", "best", 1)
+    second = enqueue_job(2, 2, "https://example.com/c", "best", 1)
+    third = enqueue_job(2, 2, "https://example.com/d", "audio", 0)
+
+    assert [get_queue_position(job) for job in (first, second, third)] == [2, 1, 0]
+    assert claim_next_job(5)["id"] == third
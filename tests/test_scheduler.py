@@ -0,0 +1,27 @@
+import asyncio
+
+import database
+from scheduler import JobScheduler
+
+
+def test_messages_are_kept_only_for_local_workers():
+    database.init_db()
+    with database.get_connection() as conn:
+        conn.execute("DELETE FROM jobs")
+
+    async def run():
+        bot_only = JobScheduler(runner=None, workers=0)
+        await bot_only.submit(10, 10, "https://example.com/1", "best", message=object())
+
+        local = JobScheduler(runner=None, workers=1)
+        taken, _ = await local.submit(11, 11, "https://example.com/2", "best", message=object())
+        waiting, _ = await local.submit(11, 11, "https://example.com/3", "best", message=object())
+        # Another node claims the bot-only node's job, then the first local one
+        while database.claim_next_job(1, "other-node")["id"] != taken:
+            pass
+        await local._prune_messages()
+        return bot_only._messages, local._messages, taken, waiting
+
+    bot_messages, local_messages, taken, waiting = asyncio.run(run())
+    assert bot_messages == {}
+    assert taken not in local_messages and waiting in local_messages
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import shutil
+import time
+
+import pytest
+
+from storage import DiskBudget, NotEnoughDiskSpace, Volume, SWEEP_MIN_AGE, estimate_job_bytes
+
+
+def _age(path):
+    old = time.time() - SWEEP_MIN_AGE - 1
+    os.utime(path, (old, old))
+
+
+def test_sweep_keeps_dirs_of_active_jobs(tmp_path):
+    budget = DiskBudget([Volume(str(tmp_path))])
+    for name in ("job-1", "job-2"):
+        os.makedirs(tmp_path / name)
+        _age(tmp_path / name)
+    # Created a moment ago by a job queued after the active jobs were read
+    os.makedirs(tmp_path / "job-3")
+
+    # Job 1 is running but has not recorded its work dir yet
+    assert budget.sweep([], [1]) == 1
+    assert sorted(os.listdir(tmp_path)) == ["job-1", "job-3"]
+
+
+def test_job_that_cannot_fit_is_refused(tmp_path):
+    free = shutil.disk_usage(tmp_path).free
+    budget = DiskBudget([Volume(str(tmp_path))], free_min=free)
+
+    with pytest.raises(NotEnoughDiskSpace):
+        asyncio.run(budget.reserve(1024, job_id=1))
+    assert not budget.reservations
+
+
+def test_job_of_unknown_size_runs_alone(tmp_path):
+    free = shutil.disk_usage(tmp_path).free
+    budget = DiskBudget([Volume(str(tmp_path))], free_min=free)
+    estimate, guessed = estimate_job_bytes(None, audio=True)
+
+    reservation = asyncio.run(budget.reserve(estimate, job_id=2, guessed=guessed))
+    assert guessed and os.path.isdir(reservation.directory)
+
+
+def test_item_dir_inside_a_job_dir_is_on_its_volume(tmp_path):
+    first, second = Volume(str(tmp_path / "a")), Volume(str(tmp_path / "b"))
+    budget = DiskBudget([first, second])
+
+    assert budget._volume_of(str(tmp_path / "a" / "job-1" / "item-0")) is first
@@ -0,0 +1,9 @@
+from uploader import guess_mime_type
+
+
+def test_guess_mime_type():
+    assert guess_mime_type("song.mp3", "audio") == "audio/mpeg"
+    assert guess_mime_type("song.m4a", "audio") == "audio/mp4"
+    assert guess_mime_type("song.webm", "audio") == "audio/webm"
+    assert guess_mime_type("clip.webm", "video") == "video/webm"
+    assert guess_mime_type("clip", "video") == "video/mp4"
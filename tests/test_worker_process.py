@@ -0,0 +1,17 @@
+import asyncio
+import sys
+
+from downloader import WorkerProcess
+
+
+def test_killed_worker_is_not_alive():
+    async def run():
+        worker = WorkerProcess()
+        worker.process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", "import time; time.sleep(60)",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+        )
+        await worker.stop()
+        return worker.is_alive
+
+    assert asyncio.run(run()) is False
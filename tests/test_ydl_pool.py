@@ -0,0 +1,32 @@
+import os
+
+from ydl_pool import YDLPool
+
+INFO = {"id": "abc", "title": "clip", "ext": "mp4"}
+
+
+def test_jobs_with_different_dirs_share_an_instance(tmp_path):
+    pool = YDLPool()
+    first_dir, second_dir = tmp_path / "job-1", tmp_path / "job-2"
+    opts = {"quiet": True, "format": "best"}
+
+    with pool.lease({**opts, "outtmpl": os.path.join(first_dir, "%(id)s.%(ext)s")}) as ydl:
+        first = ydl
+        assert ydl.prepare_filename(INFO) == os.path.join(first_dir, "abc.mp4")
+    with pool.lease({**opts, "outtmpl": os.path.join(second_dir, "%(id)s.%(ext)s")}) as ydl:
+        assert ydl is first
+        assert ydl.prepare_filename(INFO) == os.path.join(second_dir, "abc.mp4")
+    pool.close()
+
+
+def test_idle_instances_are_capped(tmp_path):
+    pool = YDLPool(size=2, max_idle=2)
+    for fmt in ("best", "worst", "bestaudio"):
+        with pool.lease({"quiet": True, "format": fmt}):
+            pass
+
+    assert pool._idle_count == 2
+    # The least recently returned option set was evicted
+    kept = [params for _, params in pool._idle]
+    assert not any("('format', 'best')" in params for params in kept)
+    pool.close()
@@ -1,66 +1,416 @@
 import sys
 import asyncio
 import os
-from pyrogram import Client
+import io
+import math
+import mimetypes
+import time
+import logging
 from config import API_ID, API_HASH, API_TOKEN
-
-# Check arguments
-if len(sys.argv) < 3:
-    print("Usage: python uploader.py <chat_id> <file_path>")
-    sys.exit(1)
-
-chat_id = int(sys.argv[1])
-file_path = sys.argv[2]
-
-if not os.path.exists(file_path):
-    print(f"File not found: {file_path}")
-    sys.exit(1)
+from database import get_upload, start_upload, mark_parts_uploaded, delete_upload, run_db
+from retry import backoff_delay
 
 try:
     import tgcrypto
-    print("Fast crypto (tgcrypto) is available.", flush=True)
+    HAS_TGCRYPTO = True
 except ImportError:
-    print("Warning: tgcrypto not found. Uploads will be slower.", flush=True)
-
-app = Client(
-    "uploader_session",
-    api_id=API_ID,
-    api_hash=API_HASH,
-    bot_token=API_TOKEN,
-    ipv6=False,
-    max_concurrent_transmissions=4
-)
-
-async def main():
-    async with app:
-        print(f"Uploading {file_path} to {chat_id}...")
-        
-        import time
-        last_print_time = 0
-
-        async def progress(current, total):
-            nonlocal last_print_time
-            current_time = time.time()
-            
-            # Print every 3 seconds to ensure user sees progress
-            if current_time - last_print_time >= 3:
-                percent = current * 100 / total
-                print(f"Progress: {percent:.1f}%", flush=True)
-                last_print_time = current_time
+    HAS_TGCRYPTO = False
 
-        try:
-            await app.send_video(
+# Directory for the Pyrogram session file (mounted as a volume in Docker)
+SESSION_DIR = os.environ.get("UPLOADER_SESSION_DIR", "sessions")
+# Number of files (and parts of one file) transferred in parallel
+UPLOADER_CONCURRENCY = int(os.environ.get("UPLOADER_CONCURRENCY", 4))
+# Upload single-file formats to Telegram while they are still downloading
+STREAMING_UPLOADS = os.environ.get("STREAMING_UPLOADS", "0") == "1"
+# Parts of a streamed upload buffered in memory (each part is 512 KB). Streams of unknown
+# size also buffer their first 10 MB, which may still be a small-file upload
+STREAM_BUFFER_PARTS = int(os.environ.get("STREAM_BUFFER_PARTS", 16))
+# Seconds an interrupted upload can be resumed (Telegram drops stale parts)
+UPLOAD_RESUME_TTL = int(os.environ.get("UPLOAD_RESUME_TTL", 6 * 3600))
+# Uploaded parts are recorded in batches of this many (and once more when the upload stops)
+UPLOAD_MARK_PARTS = int(os.environ.get("UPLOAD_MARK_PARTS", 32))
+
+# MTProto upload limits
+PART_SIZE = 512 * 1024
+BIG_FILE_SIZE = 10 * 1024 * 1024
+
+
+def guess_mime_type(file_name: str, media_type: str) -> str:
+    """MIME type of an uploaded file from its extension (an audio-only .webm is audio/webm)."""
+    guessed = mimetypes.guess_type(file_name)[0]
+    if not guessed:
+        return "audio/mpeg" if media_type == "audio" else "video/mp4"
+    if media_type == "audio" and guessed.startswith("video/"):
+        return "audio/" + guessed.split("/", 1)[1]
+    return guessed
+
+
+def get_sent_file(sent):
+    """Return (file_id, media_type) of the media in a sent Pyrogram message."""
+    if sent.video:
+        return sent.video.file_id, "video"
+    if sent.audio:
+        return sent.audio.file_id, "audio"
+    if sent.document:
+        return sent.document.file_id, "document"
+    return None, None
+
+
+async def iter_parts(chunks):
+    """Regroup an async iterator of byte chunks into 512 KB upload parts."""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= PART_SIZE:
+            yield bytes(buffer[:PART_SIZE])
+            del buffer[:PART_SIZE]
+    if buffer:
+        yield bytes(buffer)
+
+
+class Uploader:
+    """Long-lived Pyrogram (MTProto) client for files too large for the Bot API.
+
+    The client is started once and kept connected, so uploads skip the
+    interpreter startup, session setup and handshake that a subprocess pays.
+    Several uploads may run at once; Pyrogram limits parallel transfers.
+    """
+
+    def __init__(self, session_name: str = "uploader_session", in_memory: bool = False):
+        self.session_name = session_name
+        self.in_memory = in_memory
+        self.client = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_available(self) -> bool:
+        return bool(API_ID and API_HASH)
+
+    async def start(self):
+        """Connect the client (no-op if it is already running)."""
+        async with self._lock:
+            if self.client is not None and self.client.is_connected:
+                return
+            if not self.in_memory:
+                os.makedirs(SESSION_DIR, exist_ok=True)
+            if not HAS_TGCRYPTO:
+                logging.warning("tgcrypto not found. Uploads will be slower.")
+            # Imported here: Pyrogram is slow to import and only needed for large files
+            from pyrogram import Client
+
+            # Created here (not in __init__) so it binds to the running loop
+            self.client = Client(
+                self.session_name,
+                api_id=API_ID,
+                api_hash=API_HASH,
+                bot_token=API_TOKEN,
+                ipv6=False,
+                workdir=SESSION_DIR,
+                in_memory=self.in_memory,
+                max_concurrent_transmissions=UPLOADER_CONCURRENCY
+            )
+            await self.client.start()
+            logging.info("Uploader client connected")
+
+    async def stop(self):
+        async with self._lock:
+            if self.client is not None and self.client.is_connected:
+                await self.client.stop()
+                logging.info("Uploader client stopped")
+            self.client = None
+
+    async def upload(self, chat_id: int, file_path: str, media_type: str = "video",
+                     caption: str = None, progress=None):
+        """Upload a file to a chat. Returns (file_id, media_type) of the sent media.
+
+        progress is an optional (async) callable receiving (current, total) bytes.
+        """
+        await self.start()
+
+        if isinstance(file_path, str) and os.path.getsize(file_path) > BIG_FILE_SIZE:
+            return await self._upload_resumable(chat_id, file_path, media_type, caption, progress)
+
+        if media_type == "audio":
+            sent = await self.client.send_audio(
+                chat_id=chat_id,
+                audio=file_path,
+                caption=caption,
+                progress=progress
+            )
+        else:
+            sent = await self.client.send_video(
                 chat_id=chat_id,
                 video=file_path,
-                caption="Скачано с помощью @any_download_pro_bot",
+                caption=caption,
                 supports_streaming=True,
                 progress=progress
             )
-            print("Upload complete!")
+
+        return get_sent_file(sent)
+
+    async def upload_stream(self, chat_id: int, chunks, file_name: str, media_type: str = "video",
+                            caption: str = None, total_size: int = None, progress=None):
+        """Upload bytes from an async iterator while they are still being produced.
+
+        Parts are sent as soon as they are complete, with at most
+        STREAM_BUFFER_PARTS parts waiting in memory. total_size is optional;
+        without it the part count is sent as unknown (-1) until the last part.
+        Files up to BIG_FILE_SIZE must go through the small-file upload, so
+        unless total_size says the file is bigger, the first BIG_FILE_SIZE
+        bytes are buffered before any part is sent, whatever
+        STREAM_BUFFER_PARTS is. Returns (file_id, media_type) of the sent media.
+        """
+        await self.start()
+        parts = iter_parts(chunks)
+
+        # Files under 10 MB must use the small-file upload: buffer them whole
+        head = []
+        if not total_size or total_size <= BIG_FILE_SIZE:
+            async for part in parts:
+                head.append(part)
+                if len(head) * PART_SIZE > BIG_FILE_SIZE:
+                    break
+            else:
+                if not head:
+                    raise ValueError("Empty stream")
+                data = io.BytesIO(b"".join(head))
+                data.name = file_name
+                return await self.upload(chat_id, data, media_type, caption, progress)
+
+        file_id = self.client.rnd_id()
+        expected_parts = math.ceil(total_size / PART_SIZE) if total_size else -1
+        queue = asyncio.Queue(STREAM_BUFFER_PARTS)
+        errors = []
+        uploaded = 0
+
+        async def worker():
+            nonlocal uploaded
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if errors:
+                    continue  # keep draining so the producer never blocks
+                index, data, total_parts = item
+                try:
+                    await self._save_big_part(file_id, index, total_parts, data)
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                uploaded += len(data)
+                if progress:
+                    await progress(uploaded, total_size or 0)
+
+        async def all_parts():
+            for part in head:
+                yield part
+            async for part in parts:
+                yield part
+
+        workers = [asyncio.create_task(worker()) for _ in range(UPLOADER_CONCURRENCY)]
+        try:
+            # Hold one part back: the last one must carry the real part count
+            index = 0
+            previous = None
+            async for part in all_parts():
+                if errors:
+                    break
+                if previous is not None:
+                    await queue.put((index, previous, expected_parts))
+                    index += 1
+                previous = part
+            if not errors:
+                await queue.put((index, previous, index + 1))
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            await parts.aclose()
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+
+        if errors:
+            raise errors[0]
+
+        from pyrogram import raw
+
+        input_file = raw.types.InputFileBig(id=file_id, parts=index + 1, name=file_name)
+        return await self._send_uploaded(chat_id, input_file, file_name, media_type, caption)
+
+    async def _upload_resumable(self, chat_id: int, file_path: str, media_type: str,
+                                caption: str = None, progress=None):
+        """Upload a big file, skipping parts an earlier attempt already uploaded.
+
+        Uploaded parts are recorded in the database under the file's path
+        and size, so a retry (or a restart) sends only what is missing. At
+        most UPLOAD_MARK_PARTS parts are sent again after a crash.
+        """
+        file_size = os.path.getsize(file_path)
+        upload_key = f"{os.path.abspath(file_path)}:{file_size}"
+        total_parts = math.ceil(file_size / PART_SIZE)
+
+        state = await run_db(get_upload, upload_key, UPLOAD_RESUME_TTL)
+        if state is not None and state[1] == file_size:
+            file_id, _, done = state
+            logging.info(f"Resuming upload of {file_path}: {len(done)}/{total_parts} parts already sent")
+        else:
+            file_id, done = self.client.rnd_id(), set()
+            await run_db(start_upload, upload_key, file_id, file_size)
+
+        missing = asyncio.Queue()
+        for index in range(total_parts):
+            if index not in done:
+                missing.put_nowait(index)
+        uploaded = len(done) * PART_SIZE
+        marked = []  # parts uploaded but not recorded yet
+
+        async def flush_marks():
+            batch = marked[:]
+            del marked[:]
+            if batch:
+                await run_db(mark_parts_uploaded, upload_key, batch)
+
+        async def worker():
+            nonlocal uploaded
+            with open(file_path, "rb") as f:
+                while not missing.empty():
+                    index = missing.get_nowait()
+                    f.seek(index * PART_SIZE)
+                    data = f.read(PART_SIZE)
+                    await self._save_big_part(file_id, index, total_parts, data)
+                    marked.append(index)
+                    if len(marked) >= UPLOAD_MARK_PARTS:
+                        await flush_marks()
+                    uploaded += len(data)
+                    if progress:
+                        await progress(min(uploaded, file_size), file_size)
+
+        workers = [asyncio.create_task(worker()) for _ in range(UPLOADER_CONCURRENCY)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for task in workers:
+                task.cancel()
+            raise
+        finally:
+            # Parts sent before a failure are not sent again on the retry
+            await flush_marks()
+
+        from pyrogram import raw
+
+        input_file = raw.types.InputFileBig(id=file_id, parts=total_parts, name=os.path.basename(file_path))
+        try:
+            result = await self._send_uploaded(chat_id, input_file, os.path.basename(file_path), media_type, caption)
         except Exception as e:
-            print(f"Error: {e}")
-            sys.exit(1)
+            if "FILE_PART" in str(e):
+                # Telegram no longer has (some of) the parts: start over next time
+                await run_db(delete_upload, upload_key)
+            raise
+        await run_db(delete_upload, upload_key)
+        return result
+
+    async def _save_big_part(self, file_id: int, index: int, total_parts: int, data: bytes, attempts: int = 3):
+        from pyrogram import raw
+
+        for attempt in range(attempts):
+            try:
+                await self.client.invoke(
+                    raw.functions.upload.SaveBigFilePart(
+                        file_id=file_id,
+                        file_part=index,
+                        file_total_parts=total_parts,
+                        bytes=data
+                    )
+                )
+                return
+            except Exception as e:
+                if attempt == attempts - 1:
+                    raise
+                logging.warning(f"Upload of part {index} failed: {e}. Retrying...")
+                await asyncio.sleep(backoff_delay(attempt))
+
+    async def _send_uploaded(self, chat_id: int, input_file, file_name: str, media_type: str, caption: str = None):
+        """Send a file whose parts are already uploaded. Returns (file_id, media_type)."""
+        from pyrogram import raw, types, utils
+
+        mime_type = guess_mime_type(file_name, media_type)
+        if media_type == "audio":
+            attributes = [raw.types.DocumentAttributeAudio(duration=0)]
+        else:
+            attributes = [raw.types.DocumentAttributeVideo(supports_streaming=True, duration=0, w=0, h=0)]
+        attributes.append(raw.types.DocumentAttributeFilename(file_name=file_name))
+
+        r = await self.client.invoke(
+            raw.functions.messages.SendMedia(
+                peer=await self.client.resolve_peer(chat_id),
+                media=raw.types.InputMediaUploadedDocument(
+                    file=input_file,
+                    mime_type=mime_type,
+                    attributes=attributes
+                ),
+                random_id=self.client.rnd_id(),
+                **await utils.parse_text_entities(self.client, caption, None, None)
+            )
+        )
+        for update in r.updates:
+            if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                sent = await types.Message._parse(
+                    self.client, update.message,
+                    {i.id: i for i in r.users},
+                    {i.id: i for i in r.chats}
+                )
+                return get_sent_file(sent)
+        return None, None
+
+
+# Shared instance used by the bot
+uploader = Uploader()
+
+
+async def main(chat_id: int, file_path: str):
+    # Standalone run: in-memory session so it never locks the bot's session file
+    cli_uploader = Uploader("uploader_cli", in_memory=True)
+    print(f"Uploading {file_path} to {chat_id}...")
+
+    last_print_time = 0
+
+    async def progress(current, total):
+        nonlocal last_print_time
+        current_time = time.time()
+
+        # Print every 3 seconds to ensure user sees progress
+        if current_time - last_print_time >= 3:
+            percent = current * 100 / total
+            print(f"Progress: {percent:.1f}%", flush=True)
+            last_print_time = current_time
+
+    try:
+        file_id, media_type = await cli_uploader.upload(
+            chat_id, file_path,
+            caption="Скачано с помощью @any_download_pro_bot",
+            progress=progress
+        )
+        if file_id:
+            print(f"FileID: {media_type} {file_id}", flush=True)
+        print("Upload complete!")
+    except Exception as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        await cli_uploader.stop()
+
 
 if __name__ == "__main__":
-    # Run Pyrogram client
-    app.run(main())
+    # Check arguments
+    if len(sys.argv) < 3:
+        print("Usage: python uploader.py <chat_id> <file_path>")
+        sys.exit(1)
+
+    chat_id = int(sys.argv[1])
+    file_path = sys.argv[2]
+
+    if not os.path.exists(file_path):
+        print(f"File not found: {file_path}")
+        sys.exit(1)
+
+    asyncio.run(main(chat_id, file_path))
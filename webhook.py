@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+from urllib.parse import urlparse
+
+from metrics import Gauge, render, CONTENT_TYPE, metrics_authorized
+
+# Public HTTPS URL Telegram posts updates to; setting it switches bot.py from polling to a webhook
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+# Address the webhook server listens on (behind the proxy that terminates TLS)
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8080))
+# Telegram sends it back in a header, so forged updates can be rejected
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Updates handled at once, and updates buffered before new ones are refused
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 1000))
+
+
+class UpdateQueue:
+    """Acknowledges webhook updates at once and handles them in background workers.
+
+    The HTTP handler only puts the raw update on a queue, so Telegram gets
+    its 200 right away and a slow handler never holds up the updates
+    behind it. Updates received before start() wait in the queue; when
+    the queue is full, put() refuses and Telegram redelivers later.
+    """
+
+    def __init__(self, workers: int = UPDATE_WORKERS, maxsize: int = UPDATE_QUEUE_SIZE):
+        self.workers = workers
+        self._queue = asyncio.Queue(maxsize)
+        self._tasks = []
+        self._bot = None
+        self._dp = None
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    @property
+    def is_running(self) -> bool:
+        return bool(self._tasks)
+
+    def put(self, data: dict) -> bool:
+        try:
+            self._queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            logging.warning("Update queue is full, asking Telegram to redeliver")
+            return False
+
+    async def start(self, bot, dp):
+        if self._tasks:
+            return
+        self._bot, self._dp = bot, dp
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        """Finish the queued updates (up to `timeout` seconds), then stop the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Dropping {self._queue.qsize()} unhandled updates on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        from aiogram.types import Update
+
+        while True:
+            data = await self._queue.get()
+            try:
+                update = Update.model_validate(data, context={"bot": self._bot})
+                await self._dp.feed_update(self._bot, update)
+            except Exception as e:
+                logging.error(f"Failed to handle update {data.get('update_id')}: {e}")
+            finally:
+                self._queue.task_done()
+
+
+update_queue = UpdateQueue()
+
+Gauge("update_queue_size", "Webhook updates waiting for a worker.", function=lambda: len(update_queue))
+
+
+async def start_webhook_server(queue: UpdateQueue = update_queue, url: str = WEBHOOK_URL,
+                               host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+    """Receive updates at the path of `url` (and /metrics with METRICS_TOKEN). Returns the aiohttp runner."""
+    from aiohttp import web
+
+    async def handle_update(request):
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Non-2xx makes Telegram retry the update later
+        return web.Response(status=200 if queue.put(data) else 503)
+
+    async def handle_metrics(request):
+        # This listener is public: never serve metrics without the token
+        if not metrics_authorized(request.headers.get("Authorization", "")):
+            return web.Response(status=404)
+        return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    path = urlparse(url).path or "/"
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Webhook listening on {host}:{port}{path}")
+    return runner
@@ -0,0 +1,162 @@
+import copy
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import yt_dlp
+
+# Idle YoutubeDL instances kept per option set, and in total (least recently used go first)
+YDL_POOL_SIZE = int(os.environ.get("YDL_POOL_SIZE", 2))
+YDL_POOL_MAX_IDLE = int(os.environ.get("YDL_POOL_MAX_IDLE", 8))
+# Recreate an instance after this many jobs (drops accumulated state)
+YDL_MAX_USES = int(os.environ.get("YDL_MAX_USES", 100))
+# Seconds to cache DNS answers (0 disables)
+DNS_CACHE_TTL = int(os.environ.get("DNS_CACHE_TTL", 300))
+
+
+# Options that differ per job (its own directory) and are set on each lease instead
+PER_LEASE_PARAMS = ("outtmpl", "paths")
+
+
+def _params_key(params):
+    return repr(sorted((k, v) for k, v in params.items() if k not in PER_LEASE_PARAMS))
+
+
+class YDLPool:
+    """Pool of warmed-up YoutubeDL instances, leased out one job at a time.
+
+    A YoutubeDL keeps its networking layer (keep-alive connections when
+    the requests backend is installed), cookies and extractor instances,
+    so reusing it saves the TCP/TLS handshakes of a fresh object.
+    Instances are grouped by their options, because yt-dlp compiles the
+    format selector when it is created; the output template only names
+    the job's directory, so it is swapped in on every lease.
+    """
+
+    def __init__(self, size=YDL_POOL_SIZE, max_uses=YDL_MAX_USES, max_idle=YDL_POOL_MAX_IDLE):
+        self.size = size
+        self.max_uses = max_uses
+        self.max_idle = max_idle
+        self._idle = OrderedDict()  # params key -> [YoutubeDL], least recently returned first
+        self._idle_count = 0
+        self._lock = threading.Lock()
+
+    def _create(self, cls, params):
+        ydl = cls(params)
+        ydl._pool_uses = 0
+        ydl._lease_progress = None
+        # One permanent hook that forwards to the current lease's callback
+        ydl.add_progress_hook(lambda d, ydl=ydl: ydl._lease_progress and ydl._lease_progress(d))
+        return ydl
+
+    @staticmethod
+    def _apply(ydl, params):
+        for name in PER_LEASE_PARAMS:
+            if name in params:
+                ydl.params[name] = copy.deepcopy(params[name])
+            else:
+                ydl.params.pop(name, None)
+        ydl._parse_outtmpl()
+
+    @staticmethod
+    def _reset(ydl):
+        ydl._lease_progress = None
+        ydl._download_retcode = 0
+        ydl._num_downloads = 0
+        ydl._num_videos = 0
+        ydl._playlist_level = 0
+        ydl._playlist_urls = set()
+
+    @contextmanager
+    def lease(self, params, progress_callback=None, cls=yt_dlp.YoutubeDL):
+        """Borrow a YoutubeDL built with these params for one job."""
+        key = (cls, _params_key(params))
+        with self._lock:
+            idle = self._idle.get(key)
+            ydl = idle.pop() if idle else None
+            if ydl is not None:
+                self._idle_count -= 1
+                if not idle:
+                    del self._idle[key]
+        if ydl is None:
+            ydl = self._create(cls, params)
+        else:
+            self._apply(ydl, params)
+
+        ydl._lease_progress = progress_callback
+        reusable = True
+        try:
+            yield ydl
+        except yt_dlp.utils.DownloadError:
+            raise
+        except BaseException:
+            # Unknown state: do not hand this instance out again
+            reusable = False
+            raise
+        finally:
+            self._reset(ydl)
+            ydl._pool_uses += 1
+            evicted = []
+            with self._lock:
+                idle = self._idle.get(key, [])
+                if reusable and ydl._pool_uses < self.max_uses and len(idle) < self.size:
+                    idle.append(ydl)
+                    self._idle[key] = idle
+                    self._idle.move_to_end(key)
+                    self._idle_count += 1
+                    ydl = None
+                    evicted = self._evict()
+            if ydl is not None:
+                evicted.append(ydl)
+            for instance in evicted:
+                instance.close()
+
+    def _evict(self):
+        """Drop the least recently used idle instances over max_idle (lock held)."""
+        evicted = []
+        while self._idle_count > self.max_idle:
+            key, idle = next(iter(self._idle.items()))
+            evicted.append(idle.pop(0))
+            self._idle_count -= 1
+            if not idle:
+                del self._idle[key]
+        return evicted
+
+    def close(self):
+        with self._lock:
+            instances = [ydl for idle in self._idle.values() for ydl in idle]
+            self._idle = OrderedDict()
+            self._idle_count = 0
+        for ydl in instances:
+            ydl.close()
+
+
+ydl_pool = YDLPool()
+
+
+def install_dns_cache(ttl=DNS_CACHE_TTL):
+    """Cache socket.getaddrinfo answers for ttl seconds (process-wide)."""
+    if ttl <= 0 or getattr(socket.getaddrinfo, "_cached", False):
+        return
+
+    original = socket.getaddrinfo
+    cache = {}
+    lock = threading.Lock()
+
+    def getaddrinfo(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.monotonic()
+        with lock:
+            entry = cache.get(key)
+            if entry and now - entry[0] < ttl:
+                return entry[1]
+        result = original(*args, **kwargs)
+        with lock:
+            cache[key] = (now, result)
+        return result
+
+    getaddrinfo._cached = True
+    socket.getaddrinfo = getaddrinfo